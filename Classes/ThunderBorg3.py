@@ -28,18 +28,25 @@ See the website at www.piborg.org/thunderborg for more details
 
 # Import the libraries we need
 import io
+import os
+import ctypes
 import fcntl
 import types
 import time
+import random
+import threading
 
 # Constant values
 I2C_SLAVE                   = 0x0703
+I2C_RDWR                    = 0x0707
+I2C_M_RD                    = 0x0001
 PWM_MAX                     = 255
 I2C_MAX_LEN                 = 6
 VOLTAGE_PIN_MAX             = 36.3  # Maximum voltage from the analog voltage monitoring pin
 VOLTAGE_PIN_CORRECTION      = 0.0   # Correction value for the analog voltage monitoring pin
 BATTERY_MIN_DEFAULT         = 7.0   # Default minimum battery monitoring voltage
 BATTERY_MAX_DEFAULT         = 35.0  # Default maximum battery monitoring voltage
+EEPROM_WRITE_TIME           = 0.2   # Seconds to allow for an EEPROM write to complete
 
 I2C_ID_THUNDERBORG          = 0x15
 
@@ -78,33 +85,724 @@ COMMAND_VALUE_OFF           = 0     # I2C value representing off
 
 COMMAND_ANALOG_MAX          = 0x3FF # Maximum value for analog readings
 
+# Encoded frames, built once so the hot paths do not need to build them on every call
+COMMAND_FRAMES              = tuple(bytes((command,)) for command in range(256))
+MOTOR_FRAMES                = dict(
+    (command, tuple(bytes((command, pwm)) for pwm in range(PWM_MAX + 1)))
+    for command in (COMMAND_SET_A_FWD, COMMAND_SET_A_REV, COMMAND_SET_B_FWD,
+                    COMMAND_SET_B_REV, COMMAND_SET_ALL_FWD, COMMAND_SET_ALL_REV)
+)
+MOTORS_OFF_FRAME            = bytes((COMMAND_ALL_OFF, 0))
+
+PRIORITY_SAFETY             = 0     # Motors off and the failsafe, always first on to the bus
+PRIORITY_MOTION             = 1     # Motor drive levels
+PRIORITY_TELEMETRY          = 2     # Readings, and anything not listed in COMMAND_PRIORITY
+PRIORITY_COSMETIC           = 3     # The LEDs
+PRIORITY_NAMES              = ('safety', 'motion', 'telemetry', 'cosmetic')
+PRIORITY_TARGETS            = (0.001, 0.002, 0.020, 0.100)  # Seconds each class should wait for the bus at most, see SharedBus
+
+COMMAND_PRIORITY            = [PRIORITY_TELEMETRY] * 256
+for command in (COMMAND_ALL_OFF, COMMAND_SET_FAILSAFE, COMMAND_GET_FAILSAFE):
+    COMMAND_PRIORITY[command] = PRIORITY_SAFETY
+for command in (COMMAND_SET_A_FWD, COMMAND_SET_A_REV, COMMAND_SET_B_FWD,
+                COMMAND_SET_B_REV, COMMAND_SET_ALL_FWD, COMMAND_SET_ALL_REV):
+    COMMAND_PRIORITY[command] = PRIORITY_MOTION
+for command in (COMMAND_SET_LED1, COMMAND_GET_LED1, COMMAND_SET_LED2, COMMAND_GET_LED2, COMMAND_SET_LEDS,
+                COMMAND_SET_LED_BATT_MON, COMMAND_GET_LED_BATT_MON, COMMAND_WRITE_EXTERNAL_LED):
+    COMMAND_PRIORITY[command] = PRIORITY_COSMETIC
+del command
+
+# The registers each write sets, a waiting write is dropped if a newer one sets all of the same registers
+# External LED writes are left out, as each one is part of a sequence
+WRITE_REGISTERS             = {
+    COMMAND_SET_A_FWD:          frozenset(('motor1',)),
+    COMMAND_SET_A_REV:          frozenset(('motor1',)),
+    COMMAND_SET_B_FWD:          frozenset(('motor2',)),
+    COMMAND_SET_B_REV:          frozenset(('motor2',)),
+    COMMAND_SET_ALL_FWD:        frozenset(('motor1', 'motor2')),
+    COMMAND_SET_ALL_REV:        frozenset(('motor1', 'motor2')),
+    COMMAND_ALL_OFF:            frozenset(('motor1', 'motor2')),
+    COMMAND_SET_FAILSAFE:       frozenset(('failsafe',)),
+    COMMAND_SET_LED1:           frozenset(('led1',)),
+    COMMAND_SET_LED2:           frozenset(('led2',)),
+    COMMAND_SET_LEDS:           frozenset(('led1', 'led2')),
+    COMMAND_SET_LED_BATT_MON:   frozenset(('ledBattery',))
+}
+
+COMMAND_NAMES               = dict(
+    (value, name[len('COMMAND_'):]) for name, value in list(globals().items())
+    if name.startswith('COMMAND_') and isinstance(value, int) and not name.startswith(('COMMAND_VALUE_', 'COMMAND_ANALOG_'))
+)
+
+transportFactory            = None  # Called as transportFactory(busNumber, address) to open the bus, None for the default
+sharedBuses                 = {}    # The open SharedBus for each (opener, busNumber)
+sharedBusesLock             = threading.Lock()
+
+
+class I2cFileTransport:
+    """
+I2cFileTransport(busNumber, address)
+
+The default transport, talks to the I²C bus through the /dev/i2c-N device files
+    """
+
+    def __init__(self, busNumber, address):
+        self.i2cRead = io.open("/dev/i2c-" + str(busNumber), "rb", buffering = 0)
+        fcntl.ioctl(self.i2cRead, I2C_SLAVE, address)
+        self.i2cWrite = io.open("/dev/i2c-" + str(busNumber), "wb", buffering = 0)
+        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, address)
+
+
+    def write(self, data):
+        """
+write(data)
+
+Writes the bytes in data to the device in a single transaction
+        """
+        self.i2cWrite.write(data)
+
+
+    def read(self, length):
+        """
+data = read(length)
+
+Reads length bytes back from the device in a single transaction
+        """
+        return self.i2cRead.read(length)
+
+
+    def readinto(self, buffer):
+        """
+count = readinto(buffer)
+
+Reads len(buffer) bytes back from the device in a single transaction, straight into buffer
+        """
+        return self.i2cRead.readinto(buffer)
+
+
+    def set_address(self, address):
+        """
+set_address(address)
+
+Points the open device files at a different I²C address, without reopening them
+        """
+        fcntl.ioctl(self.i2cRead, I2C_SLAVE, address)
+        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, address)
+
+
+    def quick_read(self):
+        """
+quick_read()
+
+Reads a single byte, raising an IOError if nothing acknowledges at the current address
+        """
+        self.i2cRead.read(1)
+
+
+    def close(self):
+        """
+close()
+
+Closes the device files
+        """
+        self.i2cRead.close()
+        self.i2cWrite.close()
+
+
+class I2cMessage(ctypes.Structure):
+    """
+The struct i2c_msg from linux/i2c.h, one part of an I2C_RDWR transaction
+    """
+    _fields_ = [
+        ('addr',  ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len',   ctypes.c_uint16),
+        ('buf',   ctypes.POINTER(ctypes.c_uint8))
+    ]
+
+
+class I2cRdwrIoctlData(ctypes.Structure):
+    """
+The struct i2c_rdwr_ioctl_data from linux/i2c-dev.h, the argument to the I2C_RDWR ioctl
+    """
+    _fields_ = [
+        ('msgs',  ctypes.POINTER(I2cMessage)),
+        ('nmsgs', ctypes.c_uint32)
+    ]
+
+
+class I2cRdwrTransport(I2cFileTransport):
+    """
+I2cRdwrTransport(busNumber, address)
+
+Talks to the I²C bus through a single /dev/i2c-N device file
+Reads are done with one I2C_RDWR ioctl holding the command write and the reply read, joined by a repeated start
+Nothing else can use the bus between the two halves, so replies can not get mixed up with other traffic
+combinedReads counts the reads which went through as a single transaction, each one a read which another user of the
+bus could not have got in between, and so could not have had to retry, compare readRetries with I2cFileTransport
+    """
+
+    def __init__(self, busNumber, address):
+        self.i2cRead = io.open("/dev/i2c-" + str(busNumber), "r+b", buffering = 0)
+        fcntl.ioctl(self.i2cRead, I2C_SLAVE, address)
+        self.i2cWrite = self.i2cRead
+        self.address = address
+        self.combinedReads = 0
+        self.writeData = (ctypes.c_uint8 * I2C_MAX_LEN)()
+        self.messages = (I2cMessage * 2)()
+        self.ioctlData = I2cRdwrIoctlData(self.messages, 2)
+        self.readTarget = None
+
+
+    def set_address(self, address):
+        """
+set_address(address)
+
+Points the open device file at a different I²C address, without reopening it
+        """
+        fcntl.ioctl(self.i2cRead, I2C_SLAVE, address)
+        self.address = address
+
+
+    def write_read(self, data, length):
+        """
+reply = write_read(data, length)
+
+Writes data then reads length bytes back, as one combined transaction
+        """
+        writeBuffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        readBuffer = (ctypes.c_uint8 * length)()
+        messages = (I2cMessage * 2)(
+            I2cMessage(self.address, 0, len(data), writeBuffer),
+            I2cMessage(self.address, I2C_M_RD, length, readBuffer)
+        )
+        fcntl.ioctl(self.i2cRead, I2C_RDWR, I2cRdwrIoctlData(messages, 2))
+        self.combinedReads += 1
+        return bytes(readBuffer)
+
+
+    def write_readinto(self, data, buffer):
+        """
+count = write_readinto(data, buffer)
+
+Writes data then reads len(buffer) bytes back into buffer, as one combined transaction
+The ioctl arguments are built once per buffer and address, and reused after that
+        """
+        if buffer is not self.readTarget or self.messages[0].addr != self.address:
+            self.readTarget = buffer
+            self.readView = (ctypes.c_uint8 * len(buffer)).from_buffer(buffer)
+            self.messages[0] = I2cMessage(self.address, 0, 1, self.writeData)
+            self.messages[1] = I2cMessage(self.address, I2C_M_RD, len(buffer), self.readView)
+        if len(data) > I2C_MAX_LEN:
+            return self.write_read(data, len(buffer))
+        ctypes.memmove(self.writeData, data, len(data))
+        self.messages[0].len = len(data)
+        fcntl.ioctl(self.i2cRead, I2C_RDWR, self.ioctlData)
+        self.combinedReads += 1
+        return len(buffer)
+
+
+    def close(self):
+        """
+close()
+
+Closes the device file
+        """
+        self.i2cRead.close()
+
+
+class SharedBus:
+    """
+SharedBus(transport, key, address)
+
+One open transport for a whole I²C bus, shared by every ThunderBorg on that bus
+Only one transaction uses the bus at a time, and the transport is pointed at its address first if it is not there already
+Transactions which have to wait go on to the bus by priority class, see COMMAND_PRIORITY, oldest first within a class
+Left at that a busy higher class could starve the lower ones, so once the oldest transaction waiting in a class has waited
+longer than its PRIORITY_TARGETS it is promoted ahead of every class but safety, the longest waiting first
+A waiting write is dropped if a newer write for the same address sets the same registers from the same or a higher class
+The older write would only be undone, or when a higher class overtook it, would undo the newer one
+users is the number of open SharedBusTransport handles, the transport is closed along with the last one
+contended counts the uses which had to wait, addressSwitches the set_address calls
+classStats holds the counts, promotions and wait times for each priority class, see SharedBusStats
+Nothing is counted when the bus is free, so an uncontended transaction does not allocate any memory
+    """
+
+    def __init__(self, transport, key, address):
+        self.transport = transport
+        self.key = key
+        self.address = address
+        self.lock = threading.Lock()
+        self.busy = False
+        self.queues = [[] for _ in PRIORITY_NAMES]
+        self.waiting = 0
+        self.users = 0
+        self.contended = 0
+        self.addressSwitches = 0
+        self.classStats = [
+            {'waited': 0, 'replaced': 0, 'promoted': 0, 'waitTotal': 0.0, 'waitMax': 0.0, 'late': 0, 'depthMax': 0}
+            for _ in PRIORITY_NAMES
+        ]
+        self.quickRead = getattr(transport, 'quick_read', None)
+        if getattr(transport, 'write_readinto', None) is not None:
+            self.exchange = transport.write_readinto
+        elif getattr(transport, 'write_read', None) is not None:
+            self.exchange = self._ExchangeWriteRead
+        elif getattr(transport, 'readinto', None) is not None:
+            self.exchange = self._ExchangeReadInto
+        else:
+            self.exchange = self._ExchangeRead
+
+
+    def Acquire(self, address, command = None, write = False):
+        """
+granted = Acquire(address, [command], [write])
+
+Waits for the bus and points the transport at address, call Release() once the transaction is done
+command is the command code being sent, which picks the priority class, reads of a reply on their own count as telemetry
+Returns False without the bus if this is a write which a newer one made pointless while it waited
+        """
+        priority = PRIORITY_TELEMETRY if command is None else COMMAND_PRIORITY[command]
+        stats = self.classStats[priority]
+        self.lock.acquire()
+        if not self.busy:
+            # Nothing else is using the bus, so nothing can be waiting for it either
+            self.busy = True
+            self.lock.release()
+        else:
+            registers = WRITE_REGISTERS.get(command) if write else None
+            if registers is not None:
+                self._Replace(priority, address, registers)
+            queued = time.monotonic()
+            waiter = [priority, address, registers, threading.Lock(), False, queued]
+            waiter[3].acquire()
+            queue = self.queues[priority]
+            queue.append(waiter)
+            self.waiting += 1
+            if len(queue) > stats['depthMax']:
+                stats['depthMax'] = len(queue)
+            self.contended += 1
+            self.lock.release()
+            # Released by Release() handing over the bus, or by a newer write replacing this one
+            waiter[3].acquire()
+            if not waiter[4]:
+                return False
+            wait = time.monotonic() - queued
+            stats['waited'] += 1
+            stats['waitTotal'] += wait
+            if wait > stats['waitMax']:
+                stats['waitMax'] = wait
+            if wait > PRIORITY_TARGETS[priority]:
+                stats['late'] += 1
+        if address != self.address:
+            try:
+                self.transport.set_address(address)
+            except:
+                self.Release()
+                raise
+            self.address = address
+            self.addressSwitches += 1
+        return True
+
+
+    def _Replace(self, priority, address, registers):
+        """Drops the waiting writes which a new write will overwrite, the lock must be held"""
+        for lower in range(priority, len(self.queues)):
+            queue = self.queues[lower]
+            for waiter in [waiter for waiter in queue if waiter[1] == address and waiter[2] is not None]:
+                if waiter[2] <= registers:
+                    queue.remove(waiter)
+                    self.waiting -= 1
+                    self.classStats[lower]['replaced'] += 1
+                    waiter[3].release()
+
+
+    def Release(self):
+        """
+Release()
+
+Hands the bus to the highest priority transaction waiting for it, if there is one
+        """
+        self.lock.acquire()
+        if self.waiting:
+            waiter = self._Next()
+            self.waiting -= 1
+            waiter[4] = True
+            self.lock.release()
+            waiter[3].release()
+            return
+        self.busy = False
+        self.lock.release()
+
+
+    def _Next(self):
+        """Takes the next transaction off the queues, promoting any which have waited past their target, the lock must be held"""
+        queues = self.queues
+        if not queues[PRIORITY_SAFETY]:
+            now = time.monotonic()
+            late = None
+            for priority in range(PRIORITY_SAFETY + 1, len(queues)):
+                queue = queues[priority]
+                if queue and now - queue[0][5] > PRIORITY_TARGETS[priority]:
+                    if late is None or queue[0][5] < queues[late][0][5]:
+                        late = priority
+            if late is not None:
+                if any(queues[higher] for higher in range(late)):
+                    self.classStats[late]['promoted'] += 1
+                return queues[late].pop(0)
+        for queue in queues:
+            if queue:
+                return queue.pop(0)
+
+
+    def _ExchangeWriteRead(self, data, buffer):
+        """Sends a request and reads the reply into a buffer, using a combined transaction"""
+        rawReply = self.transport.write_read(data, len(buffer))
+        buffer[:len(rawReply)] = rawReply
+        return len(rawReply)
+
+
+    def _ExchangeReadInto(self, data, buffer):
+        """Sends a request, then reads the reply straight into a buffer"""
+        self.transport.write(data)
+        return self.transport.readinto(buffer)
+
+
+    def _ExchangeRead(self, data, buffer):
+        """Sends a request, then reads the reply and copies it into a buffer"""
+        self.transport.write(data)
+        rawReply = self.transport.read(len(buffer))
+        buffer[:len(rawReply)] = rawReply
+        return len(rawReply)
+
+
+class SharedBusTransport:
+    """
+SharedBusTransport(bus, address)
+
+One user's handle on a SharedBus, with the same methods as the transport it shares
+A command and the read of its reply happen in one turn on the bus, so other threads can not get in between them
+combinedReads passes on the count kept by the shared transport, see I2cRdwrTransport
+    """
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+        if bus.quickRead is None:
+            # Leave Probe to fall back on asking for the ID, as it would with the transport itself
+            self.quick_read = None
+
+
+    def write(self, data):
+        """
+write(data)
+
+Writes the bytes in data to the device in a single transaction
+        """
+        bus = self.bus
+        if not bus.Acquire(self.address, data[0], True):
+            # A newer write for the same registers has replaced this one
+            return
+        try:
+            bus.transport.write(data)
+        finally:
+            bus.Release()
+
+
+    def read(self, length):
+        """
+data = read(length)
+
+Reads length bytes back from the device in a single transaction
+        """
+        bus = self.bus
+        bus.Acquire(self.address)
+        try:
+            return bus.transport.read(length)
+        finally:
+            bus.Release()
+
+
+    def write_read(self, data, length):
+        """
+reply = write_read(data, length)
+
+Writes data then reads length bytes back, without any other user of the bus getting in between
+        """
+        reply = bytearray(length)
+        return bytes(reply[:self.write_readinto(data, reply)])
+
+
+    def write_readinto(self, data, buffer):
+        """
+count = write_readinto(data, buffer)
+
+Writes data then reads len(buffer) bytes back into buffer, without any other user of the bus getting in between
+        """
+        bus = self.bus
+        bus.Acquire(self.address, data[0])
+        try:
+            return bus.exchange(data, buffer)
+        finally:
+            bus.Release()
+
+
+    @property
+    def combinedReads(self):
+        """The combinedReads count of the shared transport, None if it does not keep one or the handle is closed"""
+        if self.bus is None:
+            return None
+        return getattr(self.bus.transport, 'combinedReads', None)
+
+
+    def set_address(self, address):
+        """
+set_address(address)
+
+Switches this handle to a different I²C address, the bus itself is only switched when the handle is next used
+        """
+        self.address = address
+
+
+    def quick_read(self):
+        """
+quick_read()
+
+Reads a single byte, raising an IOError if nothing acknowledges at the current address
+        """
+        bus = self.bus
+        bus.Acquire(self.address)
+        try:
+            bus.quickRead()
+        finally:
+            bus.Release()
+
+
+    def close(self):
+        """
+close()
+
+Lets go of the bus, closing it if nothing else is using it
+        """
+        if self.bus is not None:
+            CloseSharedBus(self.bus)
+            self.bus = None
+
+
+def OpenSharedBus(opener, busNumber, address):
+    """
+transport = OpenSharedBus(opener, busNumber, address)
+
+Returns a handle on the bus opened by opener(busNumber, address), only opening it if it is not open already
+Transports which can not be pointed at another address are returned as they are, as they can not be shared
+    """
+    key = (opener, busNumber)
+    with sharedBusesLock:
+        bus = sharedBuses.get(key)
+        if bus is None:
+            transport = opener(busNumber, address)
+            if getattr(transport, 'set_address', None) is None:
+                return transport
+            bus = SharedBus(transport, key, address)
+            sharedBuses[key] = bus
+        bus.users += 1
+    return SharedBusTransport(bus, address)
+
+
+def CloseSharedBus(bus):
+    """
+CloseSharedBus(bus)
 
-def ScanForThunderBorg(busNumber = 1):
+Drops one user of a SharedBus, closing its transport once the last user has gone
     """
-ScanForThunderBorg([busNumber])
+    with sharedBusesLock:
+        bus.users -= 1
+        if bus.users > 0:
+            return
+        if sharedBuses.get(bus.key) is bus:
+            del sharedBuses[bus.key]
+    bus.Acquire(bus.address)
+    try:
+        bus.transport.close()
+    finally:
+        bus.Release()
+
+
+def SharedBusStats():
+    """
+stats = SharedBusStats()
+
+Returns a dictionary for each open shared bus, holding its busNumber, users, contended and addressSwitches
+along with combinedReads from the transport, None if it does not do combined reads, see I2cRdwrTransport
+classes is a dictionary for each priority class, in priority order, holding its name, target and depth (waiting now)
+along with waited, replaced, promoted, waitTotal, waitMax, depthMax and late (waits over the target) from SharedBus.classStats
+    """
+    with sharedBusesLock:
+        buses = list(sharedBuses.values())
+    stats = []
+    for bus in buses:
+        classes = []
+        for priority, name in enumerate(PRIORITY_NAMES):
+            classStats = dict(bus.classStats[priority])
+            classStats.update(name = name, target = PRIORITY_TARGETS[priority], depth = len(bus.queues[priority]))
+            classes.append(classStats)
+        stats.append({
+            'busNumber': bus.key[1], 'users': bus.users, 'contended': bus.contended,
+            'addressSwitches': bus.addressSwitches, 'combinedReads': getattr(bus.transport, 'combinedReads', None),
+            'classes': classes
+        })
+    return stats
+
+
+class RetryPolicy:
+    """
+RetryPolicy([attempts], [backoff], [backoffMax], [jitter], [deadline], [retryErrors], [breakerThreshold], [breakerReset])
+
+Decides how RawRead retries, the defaults are three attempts straight after each other, which is how RawRead always worked
+attempts                The most times to send the request
+backoff                 Seconds to wait before the first retry, doubling for each retry after that, up to backoffMax
+jitter                  How much of each wait can be randomly taken off, from 0 to 1, so retries do not line up with the noise
+deadline                The most seconds a RawRead can take, no retry is started which would wait past it, None for no limit
+retryErrors             True to retry reads which raise an error, such as a NACK, as well as replies for the wrong command
+breakerThreshold        After this many RawReads in a row fail, refuse reads without using the bus for breakerReset seconds,
+                        then let one through to see if the board is back, 0 turns the circuit breaker off
+Each ThunderBorg needs its own RetryPolicy with the circuit breaker on, as the policy keeps track of the failures
+deadlineHits, trips and refused count the reads cut short by the deadline, the times the breaker opened and the reads it refused
+    """
+
+    def __init__(self, attempts = 3, backoff = 0.0, backoffMax = 0.0, jitter = 0.0, deadline = None,
+                 retryErrors = False, breakerThreshold = 0, breakerReset = 1.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoffMax = max(backoff, backoffMax)
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retryErrors = retryErrors
+        self.breakerThreshold = breakerThreshold
+        self.breakerReset = breakerReset
+        self.random = random.Random()
+        self.failures = 0
+        self.openUntil = 0.0
+        self.deadlineHits = 0
+        self.trips = 0
+        self.refused = 0
+
+
+    def Delay(self, retry):
+        """
+delay = Delay(retry)
+
+Returns how many seconds to wait before retry number retry, counting from 1
+        """
+        delay = min(self.backoffMax, self.backoff * (2 ** (retry - 1)))
+        if self.jitter > 0:
+            delay *= 1.0 - self.jitter * self.random.random()
+        return delay
+
+
+    def Allow(self):
+        """
+allowed = Allow()
+
+Returns False if the circuit breaker is open, and the read should fail without using the bus
+        """
+        if time.monotonic() < self.openUntil:
+            self.refused += 1
+            return False
+        return True
+
+
+    def Succeeded(self):
+        """
+Succeeded()
+
+Records a read which worked, closing the circuit breaker
+        """
+        self.failures = 0
+        self.openUntil = 0.0
+
+
+    def Failed(self):
+        """
+Failed()
+
+Records a read which failed every attempt, opening the circuit breaker if there have been too many in a row
+        """
+        self.failures += 1
+        if self.breakerThreshold and self.failures >= self.breakerThreshold:
+            self.openUntil = time.monotonic() + self.breakerReset
+            self.trips += 1
+
+
+def SetTransport(factory):
+    """
+SetTransport(factory)
+
+Sets how ThunderBorg instances talk to the I²C bus, called as factory(busNumber, address)
+The returned object needs write(data), read(length) and close() methods, see I2cFileTransport
+If it also has a write_read(data, length) method, RawRead uses that to send the command and read the reply together
+Optional readinto(buffer) and write_readinto(data, buffer) methods let RawRead reuse its reply buffer
+Pass None to go back to the default, which is the /dev/i2c-N device files
+Only affects instances which are initialised after the call
+    """
+    global transportFactory
+    transportFactory = factory
+
+
+def OpenTransport(busNumber, address):
+    """
+transport = OpenTransport(busNumber, address)
+
+Opens the transport for talking to the device at address on the given I²C bus
+If no transport has been set:
+    * If the THUNDERBORG_I2C_RDWR environment variable is set, I2cRdwrTransport is used
+    * Otherwise I2cFileTransport is used
+Every ThunderBorg on a bus shares the one open transport, see OpenSharedBus
+    """
+    if transportFactory is not None:
+        opener = transportFactory
+    elif os.environ.get('THUNDERBORG_I2C_RDWR'):
+        opener = I2cRdwrTransport
+    else:
+        opener = I2cFileTransport
+    return OpenSharedBus(opener, busNumber, address)
+
+
+def ScanForThunderBorg(busNumber = 1, timeBudget = None):
+    """
+ScanForThunderBorg([busNumber], [timeBudget])
 
 Scans the I²C bus for a ThunderBorg boards and returns a list of all usable addresses
 The busNumber if supplied is which I²C bus to scan, 0 for Rev 1 boards, 1 for Rev 2 boards, if not supplied the default is 1
+The timeBudget if supplied is the most seconds to spend scanning, the addresses found so far are returned when it runs out
+The bus is opened once, each address gets a quick single byte probe and only devices which answer are asked for their ID
     """
     found = []
     print('Scanning I²C bus #%d' % (busNumber))
+    start = time.monotonic()
     bus = ThunderBorg()
-    for address in range(0x03, 0x78, 1):
-        try:
-            bus.InitBusOnly(busNumber, address)
-            i2cRecv = bus.RawRead(COMMAND_GET_ID, I2C_MAX_LEN)
-            if len(i2cRecv) == I2C_MAX_LEN:
-                if i2cRecv[1] == I2C_ID_THUNDERBORG:
+    try:
+        bus.InitBusOnly(busNumber, 0x03)
+    except KeyboardInterrupt:
+        raise
+    except:
+        print('Could not open I²C bus #%d' % (busNumber))
+        return found
+    try:
+        for address in range(0x03, 0x78, 1):
+            if timeBudget is not None and time.monotonic() - start > timeBudget:
+                print('Ran out of time scanning I²C bus #%d at %02X' % (busNumber, address))
+                break
+            try:
+                if bus.Probe(address):
                     print('Found ThunderBorg at %02X' % (address))
                     found.append(address)
-                else:
-                    pass
-            else:
+            except KeyboardInterrupt:
+                raise
+            except:
                 pass
-        except KeyboardInterrupt:
-            raise
-        except:
-            pass
+    finally:
+        bus.Close()
     if len(found) == 0:
         print('No ThunderBorg boards found, is bus #%d correct (should be 0 for Rev 1, 1 for Rev 2)' % (busNumber))
     elif len(found) == 1:
@@ -114,6 +812,26 @@ The busNumber if supplied is which I²C bus to scan, 0 for Rev 1 boards, 1 for R
     return found
 
 
+def ScanBusesForThunderBorg(busNumbers = (0, 1), timeBudget = None):
+    """
+ScanBusesForThunderBorg([busNumbers], [timeBudget])
+
+Scans several I²C buses for ThunderBorg boards at the same time, by default buses 0 and 1
+Returns a dictionary of bus number to the list of usable addresses on that bus
+The timeBudget if supplied is the most seconds to spend scanning each bus
+    """
+    found = {}
+    def scan(busNumber):
+        """Scans a single bus, run on its own thread"""
+        found[busNumber] = ScanForThunderBorg(busNumber, timeBudget)
+    threads = [threading.Thread(target = scan, args = (busNumber,)) for busNumber in busNumbers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return found
+
+
 def SetNewAddress(newAddress, oldAddress = -1, busNumber = 1):
     """
 SetNewAddress(newAddress, [oldAddress], [busNumber])
@@ -190,9 +908,16 @@ class ThunderBorg:
 This module is designed to communicate with the ThunderBorg
 
 busNumber               I²C bus on which the ThunderBorg is attached (Rev 1 is bus 0, Rev 2 is bus 1)
-bus                     the smbus object used to talk to the I²C bus
+transport               the transport object used to talk to the I²C bus, see OpenTransport
 i2cAddress              The I²C address of the ThunderBorg chip to control
 foundChip               True if the ThunderBorg chip can be seen, False otherwise
+readCount               The number of RawRead calls made
+readRetries             The number of times RawRead had to retry because the reply was for the wrong command
+errorCount              The number of raw reads and writes which failed
+commandErrors           The number of raw reads and writes which failed, for each command code
+commandRetries          The number of times a request was sent again, for each command code
+retryPolicy             The RetryPolicy RawRead follows, each instance gets a default one of its own, see RetryPolicy
+readBuffer              The buffer the Get functions read replies into, shared by all of them, so use one instance from one thread at a time
 printFunction           Function reference to call when printing text, if None "print" is used
     """
 
@@ -201,8 +926,21 @@ printFunction           Function reference to call when printing text, if None "
     i2cAddress              = I2C_ID_THUNDERBORG    # I²C address, override for a different address
     foundChip               = False
     printFunction           = None
-    i2cWrite                = None
-    i2cRead                 = None
+    transport               = None
+    exchange                = None
+    readBuffer              = None
+    readCount               = 0
+    readRetries             = 0
+    errorCount              = 0
+    commandErrors           = None
+    commandRetries          = None
+    retryPolicy             = None
+
+
+    def _CountError(self, command):
+        """Records a raw read or write which failed"""
+        self.errorCount += 1
+        self.commandErrors[command] = self.commandErrors.get(command, 0) + 1
 
 
     def RawWrite(self, command, data):
@@ -214,13 +952,30 @@ Command codes can be found at the top of ThunderBorg.py, data is a list of 0 or
 
 Under most circumstances you should use the appropriate function instead of RawWrite
         """
-        rawOutput = [command]
-        rawOutput.extend(data)
-        rawOutput = bytes(rawOutput)
-        self.i2cWrite.write(rawOutput)
+        try:
+            self.transport.write(bytes((command, *data)))
+        except:
+            self._CountError(command)
+            raise
+
+
+    def RawWriteFrame(self, frame):
+        """
+RawWriteFrame(frame)
+
+Sends an already encoded command, such as one from MOTOR_FRAMES, on the I2C bus to the ThunderBorg
+frame is a bytes object holding the command code followed by its data
+
+Under most circumstances you should use the appropriate function instead of RawWriteFrame
+        """
+        try:
+            self.transport.write(frame)
+        except:
+            self._CountError(frame[0])
+            raise
 
 
-    def RawRead(self, command, length, retryCount = 3):
+    def RawRead(self, command, length, retryCount = None):
         """
 RawRead(command, length, [retryCount])
 
@@ -228,24 +983,115 @@ Reads data back from the ThunderBorg after sending a GET command
 Command codes can be found at the top of ThunderBorg.py, length is the number of bytes to read back
 
 The function checks that the first byte read back matches the requested command
-If it does not it will retry the request until retryCount is exhausted (default is 3 times)
+If it does not it will retry the request as retryPolicy allows, retryCount overrides how many attempts it makes
+If the transport supports it, the command and the reply are sent as a single combined transaction
 
 Under most circumstances you should use the appropriate function instead of RawRead
         """
-        while retryCount > 0:
-            self.RawWrite(command, [])
-            rawReply = self.i2cRead.read(length)
-            reply = []
-            for singleByte in rawReply:
-                reply.append(singleByte)
-            if command == reply[0]:
-                break
+        return bytes(self._RawReadInto(command, length, retryCount))
+
+
+    def _RawReadInto(self, command, length, retryCount = None):
+        """Does the work of RawRead, full length replies are read into readBuffer and returned without copying it
+The next read overwrites the reply, so it must be used straight away, as the Get functions do"""
+        self.readCount += 1
+        policy = self.retryPolicy
+        if policy.openUntil and not policy.Allow():
+            self._CountError(command)
+            raise IOError('I2C reads from %02X are failing, not trying command %d for now' % (self.i2cAddress, command))
+        request = COMMAND_FRAMES[command]
+        if length == I2C_MAX_LEN:
+            reply = self.readBuffer
+        else:
+            reply = bytearray(length)
+        attempts = policy.attempts if retryCount is None else retryCount
+        if policy.deadline is not None:
+            started = time.monotonic()
+        retry = 0
+        while True:
+            try:
+                count = self.exchange(request, reply)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if not policy.retryErrors or retry + 1 >= attempts:
+                    self._CountError(command)
+                    policy.Failed()
+                    raise
+                count = 0
             else:
-                retryCount -= 1
-        if retryCount > 0:
-            return reply
+                if count and command == reply[0]:
+                    break
+                self.readRetries += 1
+            retry += 1
+            if retry >= attempts:
+                self._CountError(command)
+                policy.Failed()
+                raise IOError('I2C read for command %d failed' % (command))
+            delay = policy.Delay(retry) if policy.backoff else 0.0
+            if policy.deadline is not None:
+                if time.monotonic() + delay - started > policy.deadline:
+                    policy.deadlineHits += 1
+                    self._CountError(command)
+                    policy.Failed()
+                    raise IOError('I2C read for command %d failed, out of time to retry' % (command))
+            self.commandRetries[command] = self.commandRetries.get(command, 0) + 1
+            if delay > 0:
+                time.sleep(delay)
+        if policy.failures:
+            policy.Succeeded()
+        if count < length:
+            return reply[:count]
+        return reply
+
+
+    def UseTransport(self, transport):
+        """
+UseTransport(transport)
+
+Talks to the ThunderBorg through an already open transport, picking the quickest way it offers to read replies
+Under most circumstances use Init() or InitBusOnly() instead, which open the transport for you
+        """
+        self.transport = transport
+        if self.readBuffer is None:
+            self.readBuffer = bytearray(I2C_MAX_LEN)
+        if self.commandErrors is None:
+            self.commandErrors = {}
+            self.commandRetries = {}
+        if self.retryPolicy is None:
+            # Not shared between instances, as the policy keeps track of the failures
+            self.retryPolicy = RetryPolicy()
+        if transport is None:
+            self.exchange = None
+        elif getattr(transport, 'write_readinto', None) is not None:
+            self.exchange = transport.write_readinto
+        elif getattr(transport, 'write_read', None) is not None:
+            self.exchange = self._ExchangeWriteRead
+        elif getattr(transport, 'readinto', None) is not None:
+            self.exchange = self._ExchangeReadInto
         else:
-            raise IOError('I2C read for command %d failed' % (command))
+            self.exchange = self._ExchangeRead
+
+
+    def _ExchangeWriteRead(self, request, reply):
+        """Sends a request and reads the reply into a buffer, using a combined transaction"""
+        rawReply = self.transport.write_read(request, len(reply))
+        reply[:len(rawReply)] = rawReply
+        return len(rawReply)
+
+
+    def _ExchangeReadInto(self, request, reply):
+        """Sends a request, then reads the reply straight into a buffer"""
+        self.transport.write(request)
+        return self.transport.readinto(reply)
+
+
+    def _ExchangeRead(self, request, reply):
+        """Sends a request, then reads the reply and copies it into a buffer"""
+        self.transport.write(request)
+        rawReply = self.transport.read(len(reply))
+        reply[:len(rawReply)] = rawReply
+        return len(rawReply)
 
 
     def InitBusOnly(self, busNumber, address):
@@ -255,12 +1101,56 @@ InitBusOnly(busNumber, address)
 Prepare the I2C driver for talking to a ThunderBorg on the specified bus and I2C address
 This call does not check the board is present or working, under most circumstances use Init() instead
         """
+        self.Close()
         self.busNumber = busNumber
         self.i2cAddress = address
-        self.i2cRead = io.open("/dev/i2c-" + str(self.busNumber), "rb", buffering = 0)
-        fcntl.ioctl(self.i2cRead, I2C_SLAVE, self.i2cAddress)
-        self.i2cWrite = io.open("/dev/i2c-" + str(self.busNumber), "wb", buffering = 0)
-        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, self.i2cAddress)
+        self.UseTransport(OpenTransport(self.busNumber, self.i2cAddress))
+
+
+    def SetAddress(self, address):
+        """
+SetAddress(address)
+
+Switches to talking to the device at a different I²C address on the same bus, reusing the open bus
+        """
+        setAddress = getattr(self.transport, 'set_address', None)
+        if setAddress is None:
+            self.InitBusOnly(self.busNumber, address)
+        else:
+            setAddress(address)
+            self.i2cAddress = address
+
+
+    def Probe(self, address):
+        """
+found = Probe(address)
+
+Checks if there is a ThunderBorg at the address on the current bus, returning True if there is
+Devices are only asked for their ID if they answer a quick single byte read first
+The ThunderBorg is left pointing at the address afterwards
+        """
+        self.SetAddress(address)
+        quickRead = getattr(self.transport, 'quick_read', None)
+        if quickRead is not None:
+            try:
+                quickRead()
+            except KeyboardInterrupt:
+                raise
+            except:
+                return False
+        i2cRecv = self.RawRead(COMMAND_GET_ID, I2C_MAX_LEN)
+        return len(i2cRecv) == I2C_MAX_LEN and i2cRecv[1] == I2C_ID_THUNDERBORG
+
+
+    def Close(self):
+        """
+Close()
+
+Closes the connection to the I²C bus, if one is open
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.UseTransport(None)
 
 
     def Print(self, message):
@@ -298,10 +1188,8 @@ If tryOtherBus is True, this function will attempt to use the other bus if the T
         self.Print('Loading ThunderBorg on bus %d, address %02X' % (self.busNumber, self.i2cAddress))
 
         # Open the bus
-        self.i2cRead = io.open("/dev/i2c-" + str(self.busNumber), "rb", buffering = 0)
-        fcntl.ioctl(self.i2cRead, I2C_SLAVE, self.i2cAddress)
-        self.i2cWrite = io.open("/dev/i2c-" + str(self.busNumber), "wb", buffering = 0)
-        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, self.i2cAddress)
+        self.Close()
+        self.UseTransport(OpenTransport(self.busNumber, self.i2cAddress))
 
         # Check for ThunderBorg
         try:
@@ -353,7 +1241,7 @@ SetMotor2(1)     -> motor 2 moving forward at 100% power
         if power < 0:
             # Reverse
             command = COMMAND_SET_B_REV
-            pwm = -int(PWM_MAX * power)
+            pwm = int(PWM_MAX * -power)
             if pwm > PWM_MAX:
                 pwm = PWM_MAX
         else:
@@ -364,7 +1252,7 @@ SetMotor2(1)     -> motor 2 moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            self.RawWriteFrame(MOTOR_FRAMES[command][pwm])
         except KeyboardInterrupt:
             raise
         except:
@@ -383,7 +1271,7 @@ e.g.
 1     -> motor 2 moving forward at 100% power
         """
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_B, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_B, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -414,7 +1302,7 @@ SetMotor1(1)     -> motor 1 moving forward at 100% power
         if power < 0:
             # Reverse
             command = COMMAND_SET_A_REV
-            pwm = -int(PWM_MAX * power)
+            pwm = int(PWM_MAX * -power)
             if pwm > PWM_MAX:
                 pwm = PWM_MAX
         else:
@@ -425,7 +1313,7 @@ SetMotor1(1)     -> motor 1 moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            self.RawWriteFrame(MOTOR_FRAMES[command][pwm])
         except KeyboardInterrupt:
             raise
         except:
@@ -444,7 +1332,7 @@ e.g.
 1     -> motor 1 moving forward at 100% power
         """
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_A, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_A, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -475,7 +1363,7 @@ SetMotors(1)     -> all motors are moving forward at 100% power
         if power < 0:
             # Reverse
             command = COMMAND_SET_ALL_REV
-            pwm = -int(PWM_MAX * power)
+            pwm = int(PWM_MAX * -power)
             if pwm > PWM_MAX:
                 pwm = PWM_MAX
         else:
@@ -486,7 +1374,7 @@ SetMotors(1)     -> all motors are moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            self.RawWriteFrame(MOTOR_FRAMES[command][pwm])
         except KeyboardInterrupt:
             raise
         except:
@@ -500,7 +1388,7 @@ MotorsOff()
 Sets all motors to stopped, useful when ending a program
         """
         try:
-            self.RawWrite(COMMAND_ALL_OFF, [0])
+            self.RawWriteFrame(MOTORS_OFF_FRAME)
         except KeyboardInterrupt:
             raise
         except:
@@ -542,7 +1430,7 @@ e.g.
 0.2, 0.0, 0.2 -> ThunderBorg LED dull purple
         """
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_LED1, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_LED1, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -590,7 +1478,7 @@ e.g.
 0.2, 0.0, 0.2 -> ThunderBorg Lid LED dull purple
         """
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_LED2, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_LED2, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -656,7 +1544,7 @@ If enabled the LED colours will be ignored and will use the current battery read
 This sweeps from fully green for maximum voltage (35 V) to fully red for minimum voltage (7 V)
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_LED_BATT_MON, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_LED_BATT_MON, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -699,7 +1587,7 @@ Read the current system state of the communications failsafe, True for enabled,
 The failsafe will turn the motors off unless it is commanded at least once every 1/4 of a second
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_FAILSAFE, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_FAILSAFE, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -732,7 +1620,7 @@ Note that the fault state may be true at power up, this is normal and should cle
 For more details check the website at www.piborg.org/thunderborg and double check the wiring instructions
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_DRIVE_A_FAULT, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_DRIVE_A_FAULT, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -765,7 +1653,7 @@ Note that the fault state may be true at power up, this is normal and should cle
 For more details check the website at www.piborg.org/thunderborg and double check the wiring instructions
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_DRIVE_B_FAULT, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_DRIVE_B_FAULT, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -786,7 +1674,7 @@ Reads the current battery level from the main input.
 Returns the value as a voltage based on the 3.3 V rail as a reference.
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_BATT_VOLT, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_BATT_VOLT, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -799,14 +1687,15 @@ Returns the value as a voltage based on the 3.3 V rail as a reference.
         return level + VOLTAGE_PIN_CORRECTION
 
 
-    def SetBatteryMonitoringLimits(self, minimum, maximum):
+    def SetBatteryMonitoringLimits(self, minimum, maximum, waitForEeprom = True):
         """
-SetBatteryMonitoringLimits(minimum, maximum)
+SetBatteryMonitoringLimits(minimum, maximum, [waitForEeprom])
 
 Sets the battery monitoring limits used for setting the LED colour.
 The values are between 0 and 36.3 V.
 The colours shown range from full red at minimum or below, yellow half way, and full green at maximum or higher.
 These values are stored in EEPROM and reloaded when the board is powered.
+If waitForEeprom is False the call returns straight away, the caller should wait EEPROM_WRITE_TIME itself
         """
         levelMin = minimum / float(VOLTAGE_PIN_MAX)
         levelMax = maximum / float(VOLTAGE_PIN_MAX)
@@ -815,7 +1704,8 @@ These values are stored in EEPROM and reloaded when the board is powered.
 
         try:
             self.RawWrite(COMMAND_SET_BATT_LIMITS, [levelMin, levelMax])
-            time.sleep(0.2) # Wait for EEPROM write to complete
+            if waitForEeprom:
+                time.sleep(EEPROM_WRITE_TIME) # Wait for EEPROM write to complete
         except KeyboardInterrupt:
             raise
         except:
@@ -831,7 +1721,7 @@ The values are between 0 and 36.3 V.
 The colours shown range from full red at minimum or below, yellow half way, and full green at maximum or higher.
         """ 
         try:
-            i2cRecv = self.RawRead(COMMAND_GET_BATT_LIMITS, I2C_MAX_LEN)
+            i2cRecv = self._RawReadInto(COMMAND_GET_BATT_LIMITS, I2C_MAX_LEN)
         except KeyboardInterrupt:
             raise
         except:
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Runs the input, control and telemetry loops as separate asyncio tasks """
+import asyncio
+import concurrent.futures
+import time
+from   Classes.async_thunderborg import AsyncThunderBorgClass, PRIORITY_MOTION, PRIORITY_OTHER
+from   Classes.led_state         import LED_INTERVAL
+from   Classes.mikey_monster     import KEEPALIVE_CHECK
+
+class AsyncRuntimeClass():
+    """ Drives the MikeyMonster from asyncio, with all I2C traffic going through one worker thread """
+    def __init__(self, input_handler, joystick, poll, stats = False, idle_timeout = 0.5, poll_anywhere = False):
+        """ Initialises the variables
+
+        poll returns the set of joystick ids that moved and whether to keep running, like for
+        ControlSchedulerClass, if poll_anywhere is True it is called as poll(idle_timeout) on a
+        thread of its own so it can block waiting for input, otherwise it is called as poll(0)
+        from the event loop once per tick, as pygame has to be polled from the thread it was
+        started on
+        """
+        self.input_handler = input_handler
+        self.joystick      = joystick
+        self.poll          = poll
+        self.stats         = stats
+        self.interval      = input_handler.joystick_settings.interval
+        self.idle_timeout  = idle_timeout
+        self.poll_anywhere = poll_anywhere
+        self.board         = AsyncThunderBorgClass(input_handler.mikey_monster.thunderborg)
+        self.running       = True
+        self.moved         = None
+        self.received      = None
+        self.voltage       = None
+        self.moves         = 0
+
+    def stop(self):
+        """ Stops all of the tasks """
+        self.running = False
+        if self.moved:
+            self.moved.set()
+
+    async def input_task(self):
+        """ Waits for joystick events, and wakes the control task when there are some
+
+        Where the backend allows it the waiting is done on one thread of its own, so nothing
+        wakes up while the sticks are still
+        """
+        if not self.poll_anywhere:
+            await self.input_ticks()
+            return
+        loop     = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "input")
+        try:
+            while self.running:
+                self.handle_input(*await loop.run_in_executor(executor, self.poll, self.idle_timeout))
+        finally:
+            # Lets the last poll finish, which takes at most idle_timeout
+            executor.shutdown(wait = True)
+
+    async def input_ticks(self):
+        """ Checks for joystick events once per tick from the event loop, for backends tied to the main thread """
+        poll_interval = self.interval if self.interval > 0 else 0.01
+        while self.running:
+            self.handle_input(*self.poll(0))
+            await asyncio.sleep(poll_interval)
+
+    def handle_input(self, moved, running):
+        """ Wakes the control task if any joystick moved, and stops everything if told to """
+        if moved and self.received is None:
+            self.received = time.monotonic()
+            self.moved.set()
+        if not running:
+            self.stop()
+
+    async def control_task(self):
+        """ Sends one move per tick, using the latest stick state """
+        while self.running:
+            await self.moved.wait()
+            self.moved.clear()
+            if not self.running:
+                break
+            received, self.received = self.received, None
+            if self.input_handler.manage_event(self.joystick):
+                # Motor commands go to the front of the I2C queue
+                await self.board.call(PRIORITY_MOTION, self.input_handler.perform_move)
+                self.moves += 1
+            if self.stats:
+                self.stats.event_handled(received)
+            await asyncio.sleep(self.interval)
+
+    async def keepalive_task(self):
+        """ Stops the failsafe tripping while the sticks are held still """
+        while self.running:
+            await self.board.call(PRIORITY_MOTION, self.input_handler.mikey_monster.keepalive)
+            await asyncio.sleep(KEEPALIVE_CHECK)
+
+    async def led_task(self):
+        """ Writes any LED changes, behind the motor commands in the I2C queue """
+        while self.running:
+            await self.board.call(PRIORITY_OTHER, self.input_handler.mikey_monster.leds.flush)
+            await asyncio.sleep(LED_INTERVAL)
+
+    async def sampler_task(self):
+        """ Reads the telemetry channels when they are due, one read at a time behind the motor commands
+
+        The sampler's own thread is not started in this mode, so every read goes through the I2C worker
+        """
+        telemetry = self.input_handler.mikey_monster.telemetry
+        minimum   = None
+        limits    = await self.board.GetBatteryMonitoringLimits()
+        if limits:
+            minimum = limits[0]
+        while self.running:
+            for name in telemetry.due_channels():
+                await self.board.call(PRIORITY_OTHER, telemetry.sample, name)
+            voltage = telemetry.latest("battery")
+            if voltage is not None:
+                if minimum is not None and self.voltage is not None and voltage < minimum <= self.voltage:
+                    print("Battery low: %02.2f V" % (voltage))
+                self.voltage = voltage
+            await asyncio.sleep(telemetry.next_wait())
+
+    async def run(self):
+        """ Runs the tasks until told to stop """
+        self.moved = asyncio.Event()
+        tasks = [
+            asyncio.create_task(self.input_task()),
+            asyncio.create_task(self.control_task()),
+            asyncio.create_task(self.keepalive_task()),
+            asyncio.create_task(self.led_task()),
+            asyncio.create_task(self.sampler_task())
+        ]
+        try:
+            await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            self.stop()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            self.board.close()
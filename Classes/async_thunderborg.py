@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Awaitable versions of the ThunderBorg commands, run one at a time on a dedicated I2C thread """
+import asyncio
+import concurrent.futures
+import itertools
+import queue
+import threading
+import Classes.ThunderBorg3    as thunderborg
+
+# Lower numbers go to the bus first
+PRIORITY_MOTION = 0
+PRIORITY_OTHER  = 1
+
+# The commands which jump the queue ahead of everything else
+MOTION_COMMANDS = ("SetMotor1", "SetMotor2", "SetMotors", "MotorsOff", "SetCommsFailsafe")
+
+class I2cWorkerClass():
+    """ Owns the I2C bus, running the calls given to it one at a time, motion first
+
+    The priority only orders the calls which are still waiting, a motor command still has to
+    wait for whatever call is already running, such as a slow read, to finish first
+    """
+    def __init__(self):
+        """ Starts the worker thread """
+        self.queue    = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.thread   = threading.Thread(target = self._run, name = "i2c-worker", daemon = True)
+        self.thread.start()
+
+    def submit(self, priority, function, *args):
+        """ Queues a call, returning a concurrent.futures.Future for its result """
+        future = concurrent.futures.Future()
+        self.queue.put((priority, next(self.sequence), future, function, args))
+        return future
+
+    def stop(self):
+        """ Stops the worker once everything already queued has run """
+        self.queue.put((PRIORITY_OTHER + 1, next(self.sequence), None, None, None))
+        self.thread.join()
+
+    def _run(self):
+        """ Runs the queued calls until told to stop """
+        while True:
+            _, _, future, function, args = self.queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as ex: # pylint: disable=W0703
+                future.set_exception(ex)
+
+class AsyncThunderBorgClass():
+    """ Wraps a ThunderBorg so every command can be awaited, e.g. await board.GetBatteryReading() """
+    def __init__(self, board, worker = None):
+        """ Initialises the variables """
+        self.board  = board
+        self.worker = worker if worker is not None else I2cWorkerClass()
+
+    async def call(self, priority, function, *args):
+        """ Runs any function on the I2C worker, and waits for its result """
+        return await asyncio.wrap_future(self.worker.submit(priority, function, *args))
+
+    async def SetBatteryMonitoringLimits(self, minimum, maximum): # pylint: disable=C0103
+        """ Sets the battery limits, waiting for the EEPROM write here rather than on the I2C worker """
+        await self.call(PRIORITY_OTHER, self.board.SetBatteryMonitoringLimits, minimum, maximum, False)
+        await asyncio.sleep(thunderborg.EEPROM_WRITE_TIME)
+
+    def __getattr__(self, name):
+        """ Returns an awaitable version of a ThunderBorg command """
+        function = getattr(self.board, name)
+        if name.startswith("_") or not callable(function):
+            raise AttributeError(name)
+        priority = PRIORITY_MOTION if name in MOTION_COMMANDS else PRIORITY_OTHER
+        async def command(*args):
+            """ Runs the command on the I2C worker """
+            return await self.call(priority, function, *args)
+        command.__name__ = name
+        return command
+
+    def close(self):
+        """ Stops the I2C worker """
+        self.worker.stop()
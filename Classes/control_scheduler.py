@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Runs the control loop at a fixed rate, so the motors only get one command per tick """
+import time
+
+class ControlSchedulerClass():
+    """ Merges the joystick events that arrive between ticks into a single move per tick """
+    def __init__(self, poll, interval, stats = False, idle_timeout = 0.5):
+        """ Initialises the variables
+
+        poll is called as poll(timeout), and should block for up to timeout seconds waiting
+        for input, returning the set of joystick ids that moved and whether to keep running
+        """
+        self.poll          = poll
+        self.interval      = float(interval)
+        self.stats         = stats
+        self.idle_timeout  = idle_timeout
+        self.robots        = {}
+        # Main thread CPU seconds spent on each input handler, in the order they were added
+        self.robot_cpu     = {}
+        self.started       = None
+        self.pending       = {}
+        self.idle_tasks    = []
+        self.idle_interval = None
+        self.running       = True
+        self.ticks         = 0
+        self.moves         = 0
+        self.merged_events = 0
+        self.dropped_ticks = 0
+
+    def add_robot(self, joystick_id, input_handler, joystick):
+        """ Pairs a joystick with the input handler it controls, events are routed by the joystick id """
+        self.robots[joystick_id] = (input_handler, joystick)
+        self.robot_cpu.setdefault(input_handler, 0.0)
+
+    def add_idle_task(self, function, interval, robot = None):
+        """ Calls function() in the time left between ticks, at least every interval seconds
+
+        If robot is the input handler the task belongs to, its CPU time counts towards that robot
+        """
+        self.idle_tasks.append((function, robot))
+        if robot is not None:
+            self.robot_cpu.setdefault(robot, 0.0)
+        if self.idle_interval is None or interval < self.idle_interval:
+            self.idle_interval = interval
+
+    def stop(self):
+        """ Stops the scheduler at the end of the current tick """
+        self.running = False
+
+    def gather(self, timeout):
+        """ Waits for input, and marks the robots whose joysticks moved as pending """
+        moved, running = self.poll(timeout)
+        received       = time.monotonic()
+        for joystick_id in moved:
+            if joystick_id not in self.robots:
+                continue
+            if joystick_id in self.pending:
+                # Only the latest stick state matters, so fold this event into the pending one
+                self.merged_events += 1
+            else:
+                self.pending[joystick_id] = received
+        if not running:
+            self.stop()
+
+    def tick(self):
+        """ Sends one move for every robot which has had input since the last tick """
+        self.ticks += 1
+        pending      = self.pending
+        self.pending = {}
+        for joystick_id, received in pending.items():
+            input_handler, joystick = self.robots[joystick_id]
+            started = time.thread_time()
+            if input_handler.execute_move(joystick):
+                self.moves += 1
+            self.robot_cpu[input_handler] += time.thread_time() - started
+            if self.stats:
+                self.stats.event_handled(received)
+
+    def run(self):
+        """ Runs the control loop until told to stop """
+        next_tick    = time.monotonic()
+        idle_wait    = self.idle_timeout
+        self.started = next_tick
+        if self.idle_interval is not None:
+            # Wake up often enough for the idle tasks, even with nothing moving
+            idle_wait = min(idle_wait, self.idle_interval)
+        while self.running:
+            if self.pending:
+                # Something is waiting to be sent, so only wait until the next tick
+                self.gather(max(0.0, next_tick - time.monotonic()))
+            else:
+                self.gather(idle_wait)
+                # Nothing has moved in a while, so the tick can start straight away
+                next_tick = max(next_tick, time.monotonic())
+            now = time.monotonic()
+            if self.pending and now >= next_tick:
+                self.tick()
+                next_tick += self.interval
+                if next_tick < now:
+                    # Fallen behind, drop the missed ticks rather than trying to catch up
+                    if self.interval > 0:
+                        self.dropped_ticks += int((now - next_tick) / self.interval) + 1
+                    next_tick = now + self.interval
+            for function, robot in self.idle_tasks:
+                if robot is None:
+                    function()
+                    continue
+                started = time.thread_time()
+                function()
+                self.robot_cpu[robot] += time.thread_time() - started
+
+    def report(self):
+        """ Outputs the scheduler statistics """
+        print("Control scheduler:")
+        print("  Tick interval        %5.1f ms" % (self.interval * 1000.0))
+        print("  Ticks                %d" % (self.ticks))
+        print("  Moves sent           %d" % (self.moves))
+        print("  Events merged        %d" % (self.merged_events))
+        print("  Ticks dropped        %d" % (self.dropped_ticks))
+        wall = time.monotonic() - self.started if self.started is not None else 0.0
+        for number, cpu in enumerate(self.robot_cpu.values(), 1):
+            # Only the main loop's share, the telemetry threads are on top of this
+            print("  %-21s%5.2f %%" % ("Robot %d CPU" % (number), 100.0 * cpu / wall if wall > 0 else 0.0))
+        print("")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Remembers where the ThunderBorg was found, so the next startup can go straight to it """
+import json
+import os
+from   Classes.mikey_functions import absolute_path
+
+class DiscoveryCacheClass():
+    """ Stores the bus, address and board ID which worked last time """
+    def __init__(self, path = absolute_path("thunderborg_cache.json")):
+        """ Initialises the variables """
+        self.path = path
+
+    def load(self):
+        """ Returns the cached bus, address and board ID, or None if there is nothing usable """
+        try:
+            with open(self.path) as cache_file:
+                cached = json.load(cache_file)
+            return int(cached["bus"]), int(cached["address"]), int(cached["board_id"])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, bus, address, board_id):
+        """ Records where the board was found """
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as cache_file:
+                json.dump({"bus": bus, "address": address, "board_id": board_id}, cache_file)
+            # Replace the old cache in one go, so a power cut can not leave half a file
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as ex:
+            print("Could not save the ThunderBorg discovery cache: " + str(ex))
+
+    def clear(self):
+        """ Forgets the cached board """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
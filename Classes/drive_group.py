@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Drives the left and right sides of the robot, where each side can be spread over several ThunderBorgs """
+import time
+import Classes.ThunderBorg3  as thunderborg
+from   Classes.motor_writer import MotorWriterClass
+
+# Once a tick's motor writes have taken this long, in seconds, the boards still to be written wait for the next tick
+TICK_BUDGET = 0.01
+
+def reverse(state):
+    """ Returns the (direction, pwm) for a motor which is wired the other way round """
+    direction, pwm = state
+    if direction == thunderborg.COMMAND_VALUE_REV:
+        return thunderborg.COMMAND_VALUE_FWD, pwm
+    return thunderborg.COMMAND_VALUE_REV, pwm
+
+class DriveGroupClass():
+    """ Maps the left and right sides onto any number of (board, motor) outputs, and writes them a tick at a time """
+    def __init__(self, outputs, resend_interval = 0.1, budget = TICK_BUDGET):
+        """ Sets up a motor writer for each board
+
+        outputs is a list of (side, board, motor, reversed), where side is "left" or "right"
+        and motor is 1 or 2, boards are written in the order they first appear, resend_interval
+        is passed on to each MotorWriterClass
+
+        Once a tick has used up budget seconds the rest of the boards are left for the next tick,
+        or for finish, and are written first then so the same boards are not always the late ones,
+        a tick can only go over by the board it was writing when the time ran out, and stop is
+        never held back
+        """
+        self.writers    = []
+        self.routes     = []
+        self.budget     = budget
+        for side, board, motor, reversed_motor in outputs:
+            for writer, route in zip(self.writers, self.routes):
+                if writer.board is board:
+                    break
+            else:
+                writer = MotorWriterClass(board, resend_interval)
+                route  = {1: None, 2: None}
+                self.writers.append(writer)
+                self.routes.append(route)
+            route[motor] = (side, reversed_motor)
+        self.plan       = [(writer, route[1], route[2]) for writer, route in zip(self.writers, self.routes)]
+        self.ticks      = 0
+        self.tick_total = 0.0
+        self.tick_max   = 0.0
+        self.overruns   = 0
+        self.deferred   = 0
+        self.first      = 0
+        self.pending    = None
+
+    @staticmethod
+    def output_state(route, sides):
+        """ Returns the state for one output, or None if nothing is connected to it """
+        if route is None:
+            return None
+        side, reversed_motor = route
+        state = sides[side]
+        return reverse(state) if reversed_motor else state
+
+    def set_sides(self, left, right):
+        """ Sends the (direction, pwm) for each side to every board, as one batch, until the budget runs out """
+        start    = time.perf_counter()
+        deadline = start + self.budget
+        sides    = {"left": left, "right": right}
+        plan     = self.plan
+        count    = len(plan)
+        first    = self.first
+        self.first   = 0
+        self.pending = None
+        for offset in range(count):
+            index = (first + offset) % count
+            if offset and time.perf_counter() > deadline:
+                # Out of time, the rest go first next time
+                self.first    = index
+                self.pending  = (left, right)
+                self.deferred += count - offset
+                break
+            writer, route1, route2 = plan[index]
+            state1 = self.output_state(route1, sides)
+            state2 = self.output_state(route2, sides)
+            if state1 is None:
+                writer.set_state(2, state2)
+            elif state2 is None:
+                writer.set_state(1, state1)
+            else:
+                writer.set_states(state1, state2)
+        taken = time.perf_counter() - start
+        self.ticks      += 1
+        self.tick_total += taken
+        if taken > self.tick_max:
+            self.tick_max = taken
+        if taken > self.budget:
+            self.overruns += 1
+
+    def finish(self):
+        """ Writes the boards left over from a tick which ran out of time, returning True if there were any """
+        if self.pending is None:
+            return False
+        # The boards which were already written suppress the repeats
+        self.set_sides(*self.pending)
+        return True
+
+    def keepalive(self, timeout):
+        """ Keeps the failsafe on every board from tripping, returning True if anything was sent """
+        sent = False
+        for writer in self.writers:
+            sent = writer.keepalive(timeout) or sent
+        return sent
+
+    def stop(self):
+        """ Turns every motor off, whatever was last sent """
+        self.pending = None
+        self.first   = 0
+        for writer in self.writers:
+            writer.board.MotorsOff()
+            writer.forget()
+
+    def forget(self):
+        """ Forgets the motor states, so the next commands are always sent """
+        for writer in self.writers:
+            writer.forget()
+
+    def report(self):
+        """ Outputs the motor write and tick timing statistics, for all of the boards together """
+        sent       = sum(writer.sent for writer in self.writers)
+        suppressed = sum(writer.suppressed for writer in self.writers)
+        total      = sent + suppressed
+        print("Motor writes (%d board%s):" % (len(self.writers), "" if len(self.writers) == 1 else "s"))
+        print("  Sent                 %d" % (sent))
+        print("  Suppressed           %d (%.1f %%)" % (suppressed, 100.0 * suppressed / total if total else 0.0))
+        print("  Sent to both motors  %d" % (sum(writer.combined for writer in self.writers)))
+        print("  Keepalives           %d" % (sum(writer.keepalives for writer in self.writers)))
+        if self.ticks:
+            print("  Average batch        %6.3f ms" % (1000.0 * self.tick_total / self.ticks))
+            print("  Slowest batch        %6.3f ms" % (1000.0 * self.tick_max))
+            print("  Over %.0f ms           %d" % (1000.0 * self.budget, self.overruns))
+            print("  Boards held back     %d" % (self.deferred))
+        print("")
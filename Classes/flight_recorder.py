@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Records the control and telemetry data for every tick into a memory mapped circular file """
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC   = b"MMFR"
+VERSION = 1
+# Magic, version, record size, capacity, index of the next record to write
+HEADER  = struct.Struct("<4sHHIQ")
+# Time, vertical, horizontal, drive left, drive right, slow, motor 1 and 2 direction and pwm, I2C errors, battery
+RECORD  = struct.Struct("<dffffBBBBBxxxIf")
+FIELDS  = (
+    "time", "vertical", "horizontal", "drive_left", "drive_right", "slow",
+    "direction1", "pwm1", "direction2", "pwm2", "i2c_errors", "battery"
+)
+
+class FlightRecorderClass():
+    """ Keeps the last few minutes of records in a preallocated file, which survives crashes """
+    def __init__(self, path, minutes = 10.0, rate = 50.0, flush_interval = 1.0):
+        """ Opens the file, carrying on from the records already in it if the layout matches """
+        self.capacity       = int(minutes * 60.0 * rate)
+        self.flush_interval = flush_interval
+        size                = HEADER.size + self.capacity * RECORD.size
+        self.file           = open(path, "a+b")
+        if os.fstat(self.file.fileno()).st_size != size:
+            self.file.truncate(size)
+        self.map            = mmap.mmap(self.file.fileno(), size)
+        magic, version, record_size, capacity, index = HEADER.unpack_from(self.map, 0)
+        if (magic, version, record_size, capacity) != (MAGIC, VERSION, RECORD.size, self.capacity):
+            index = 0
+        self.index          = index
+        self.flushed        = index
+        self.flushed_at     = time.monotonic()
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.index)
+
+    def record(self, vertical, horizontal, drive_left, drive_right, slow, motor1, motor2, i2c_errors, battery):
+        """ Writes a record, motor1 and motor2 are the (direction, pwm) last sent, or None """
+        direction1, pwm1 = motor1 or (0, 0)
+        direction2, pwm2 = motor2 or (0, 0)
+        offset = HEADER.size + (self.index % self.capacity) * RECORD.size
+        RECORD.pack_into(
+            self.map, offset, time.time(), vertical, horizontal, drive_left, drive_right, bool(slow),
+            direction1, pwm1, direction2, pwm2, i2c_errors, math.nan if battery is None else battery
+        )
+        self.index += 1
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.index)
+        # The page cache keeps the records if the process dies, this gets them to disk for power cuts
+        now = time.monotonic()
+        if now - self.flushed_at >= self.flush_interval:
+            self.flush()
+            self.flushed_at = now
+
+    def flush(self):
+        """ Writes the records since the last flush out to disk """
+        if self.index - self.flushed >= self.capacity or self.index % self.capacity < self.flushed % self.capacity:
+            # Wrapped around, so just do the lot
+            self.map.flush()
+        else:
+            start = HEADER.size + (self.flushed % self.capacity) * RECORD.size
+            start = start - start % mmap.PAGESIZE
+            end   = HEADER.size + (self.index % self.capacity) * RECORD.size
+            self.map.flush(0, HEADER.size)
+            if end > start:
+                self.map.flush(start, end - start)
+        self.flushed = self.index
+
+    def close(self):
+        """ Flushes and closes the file """
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+def read_records(path):
+    """ Yields the records in a flight recorder file as dictionaries, oldest first """
+    with open(path, "rb") as recorder_file:
+        data = recorder_file.read()
+    magic, version, record_size, capacity, index = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError("%s is not a flight recorder file" % (path))
+    for number in range(max(0, index - capacity), index):
+        offset = HEADER.size + (number % capacity) * RECORD.size
+        yield dict(zip(FIELDS, RECORD.unpack_from(data, offset)))
+
+def main():
+    """ Outputs a flight recorder file as CSV """
+    if len(sys.argv) != 2:
+        print("Usage: python3 -m Classes.flight_recorder <file>")
+        sys.exit(1)
+    print(",".join(FIELDS))
+    for record in read_records(sys.argv[1]):
+        print(",".join(str(record[field]) for field in FIELDS))
+
+if __name__ == "__main__":
+    main()
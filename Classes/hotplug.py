@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Watches /dev/input with inotify, so joysticks being plugged in and unplugged are noticed straight away """
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import threading
+import time
+
+IN_ATTRIB       = 0x00000004
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_NONBLOCK     = 0o4000
+IN_CLOEXEC      = 0o2000000
+# udev creates the node and then sets its permissions, so either can be the moment it becomes usable
+ADDED_MASK      = IN_CREATE | IN_ATTRIB | IN_MOVED_TO
+REMOVED_MASK    = IN_DELETE | IN_MOVED_FROM
+# struct inotify_event from sys/inotify.h: watch descriptor, mask, cookie, name length
+INOTIFY_EVENT   = struct.Struct("iIII")
+INPUT_DIRECTORY = "/dev/input"
+# How long after a joystick disappears the motors should have stopped, in seconds
+STOP_DEADLINE   = 0.1
+
+class HotplugWatcherClass():
+    """ Reports the device nodes matching some patterns being added to or removed from a directory """
+    def __init__(self, patterns = ("js*",), directory = INPUT_DIRECTORY):
+        """ Starts watching the directory, raising OSError if inotify cannot be used """
+        libc           = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        self.patterns  = tuple(patterns)
+        self.directory = directory
+        self.fd        = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "inotify_init1: %s" % (os.strerror(error)))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), ADDED_MASK | REMOVED_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "Cannot watch %s: %s" % (directory, os.strerror(error)))
+        self.thread    = None
+        self.wake      = None
+
+    def fileno(self):
+        """ Returns the inotify fd, so the watcher can be passed to select """
+        return self.fd
+
+    def read_changes(self):
+        """ Reads the waiting events, returning a list of (path, present) in the order they happened """
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name    = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if not any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                    continue
+                changes.append((os.path.join(self.directory, name), not mask & REMOVED_MASK))
+        return changes
+
+    def start(self, on_change):
+        """ Calls on_change(changes) from a background thread, for loops which cannot select on the watcher """
+        if self.thread is None:
+            self.wake   = os.pipe()
+            self.thread = threading.Thread(target = self._run, args = (on_change,), name = "hotplug", daemon = True)
+            self.thread.start()
+
+    def _run(self, on_change):
+        """ Waits for changes, until woken by close """
+        while True:
+            readable, _, _ = select.select([self.fd, self.wake[0]], [], [])
+            if self.wake[0] in readable:
+                break
+            changes = self.read_changes()
+            if changes:
+                on_change(changes)
+
+    def close(self):
+        """ Stops the background thread, if there is one, and stops watching """
+        if self.thread is not None:
+            os.write(self.wake[1], b"\0")
+            self.thread.join()
+            os.close(self.wake[0])
+            os.close(self.wake[1])
+            self.thread = None
+        os.close(self.fd)
+
+class HotplugStatsClass():
+    """ Counts the joysticks lost and found again, and how long the motors took to stop each time """
+    def __init__(self, deadline = STOP_DEADLINE):
+        """ Initialises the variables """
+        self.deadline   = deadline
+        self.removals   = 0
+        self.reconnects = 0
+        self.late_stops = 0
+        self.stop_max   = 0.0
+
+    def removed(self, noticed, stop = None, *args):
+        """ Calls stop(*args), then records how long it has been since the removal was noticed """
+        self.removals += 1
+        if stop:
+            stop(*args)
+        taken = time.monotonic() - noticed
+        self.stop_max = max(self.stop_max, taken)
+        if taken > self.deadline:
+            self.late_stops += 1
+            print("Joystick lost, but the motors took %.1f ms to stop" % (taken * 1000.0))
+
+    def reconnected(self):
+        """ Records a joystick coming back """
+        self.reconnects += 1
+
+    def report(self):
+        """ Outputs the hotplug statistics """
+        print("Joystick hotplug:")
+        print("  Lost                 %d" % (self.removals))
+        print("  Reconnected          %d" % (self.reconnects))
+        print("  Slowest stop         %5.1f ms" % (self.stop_max * 1000.0))
+        print("  Over %3d ms          %d" % (self.deadline * 1000.0, self.late_stops))
+        print("")
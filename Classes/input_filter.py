@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Conditions the stick positions, so drift around the centre and tiny jitter do not reach the motors """
+import math
+import time
+
+class InputFilterClass():
+    """ Applies a radial deadband with hysteresis and a deadzone for each axis, then holds each axis until it moves by more than its threshold
+
+    An axis inside its deadzone comes out as exactly zero, so whatever is after the filter only
+    has to check for zero rather than applying the deadzone again to the rescaled value
+    """
+    def __init__(self, joystick_settings):
+        """ Initialises the variables from the joystick settings """
+        self.deadzone   = joystick_settings.deadzone
+        self.deadband   = joystick_settings.deadband
+        self.hysteresis = joystick_settings.hysteresis
+        self.thresholds = (joystick_settings.vertical_step, joystick_settings.horizontal_step)
+        self.started    = time.monotonic()
+        self.passed     = 0
+        self.suppressed = 0
+        self.reset()
+
+    def reset(self):
+        """ Forgets the last output, so the next input always counts as a change """
+        self.centred    = True
+        self.vertical   = None
+        self.horizontal = None
+        self.slow       = None
+
+    def condition(self, vertical, horizontal, slow):
+        """ Returns the conditioned (vertical, horizontal), and whether anything changed enough to be sent """
+        radius = math.hypot(vertical, horizontal)
+        if self.centred:
+            # The stick has to go a bit further out to leave the centre than it has to come back to return to it
+            self.centred = radius <= self.deadband + self.hysteresis
+        else:
+            self.centred = radius < self.deadband
+        if self.centred:
+            vertical = horizontal = 0.0
+        else:
+            # Checked against where the stick really is, before any rescaling
+            vertical_still   = abs(vertical) < self.deadzone
+            horizontal_still = abs(horizontal) < self.deadzone
+            if self.deadband > 0:
+                # Start again from zero at the edge of the deadband, rather than jumping straight to it
+                scale      = (radius - self.deadband) / ((1.0 - self.deadband) * radius)
+                vertical   = max(-1.0, min(1.0, vertical * scale))
+                horizontal = max(-1.0, min(1.0, horizontal * scale))
+            if vertical_still:
+                vertical = 0.0
+            if horizontal_still:
+                horizontal = 0.0
+        vertical   = self.hold(vertical, self.vertical, self.thresholds[0])
+        horizontal = self.hold(horizontal, self.horizontal, self.thresholds[1])
+        changed    = (vertical, horizontal, slow) != (self.vertical, self.horizontal, self.slow)
+        self.vertical, self.horizontal, self.slow = vertical, horizontal, slow
+        if changed:
+            self.passed += 1
+        else:
+            self.suppressed += 1
+        return vertical, horizontal, changed
+
+    @staticmethod
+    def hold(value, last, threshold):
+        """ Returns the last value if the new one is too close to it to matter, going back to the centre always counts """
+        if last is not None and value != 0.0 and abs(value - last) < threshold:
+            return last
+        return value
+
+    def suppressed_per_minute(self):
+        """ Returns how many moves have been suppressed per minute, on average """
+        minutes = (time.monotonic() - self.started) / 60.0
+        if minutes <= 0:
+            return 0.0
+        return self.suppressed / minutes
+
+    def report(self):
+        """ Outputs how many moves the filter let through and suppressed """
+        print("Input filter:")
+        print("  Deadband             %.3f (+%.3f to leave the centre)" % (self.deadband, self.hysteresis))
+        print("  Moves sent           %d" % (self.passed))
+        print("  Moves suppressed     %d (%.1f per minute)" % (self.suppressed, self.suppressed_per_minute()))
+        print("")
@@ -1,33 +1,58 @@
 #!/usr/bin/env python3
 # coding: Latin-1
 """ Contains the InputHandler functionality """
-from   Classes.mikey_monster import JoystickSettingsClass, MikeyMonsterClass, PowerSettingsClass
+from   Classes.input_filter  import InputFilterClass
+from   Classes.mikey_monster import DriveSettingsClass, JoystickSettingsClass, MikeyMonsterClass, PowerSettingsClass
+from   Classes.mixer         import MixerClass, mixer_available
+import Classes.ThunderBorg3  as thunderborg
+
+def drive_level(state):
+    """ Returns the drive level from -1 to +1 for a (direction, pwm) """
+    level = state[1] / float(thunderborg.PWM_MAX)
+    return -level if state[0] == thunderborg.COMMAND_VALUE_REV else level
 
 class InputHandlerClass():
     """ Acts as a bridge between all the different parts """
-    def __init__(self):
-        """ Initialises the variables """
+    def __init__(self, location = None):
+        """ Initialises the variables, location is the (bus number, address) of the board if it is known """
         self.joystick_settings = JoystickSettingsClass()
         self.power_settings    = PowerSettingsClass()
-        self.mikey_monster     = MikeyMonsterClass(self.joystick_settings, self.power_settings)
+        self.drive_settings    = DriveSettingsClass()
+        self.mikey_monster     = MikeyMonsterClass(
+            self.joystick_settings,
+            self.power_settings,
+            self.drive_settings,
+            location
+        )
         self.drive_left        = 0.0
         self.drive_right       = 0.0
         self.horizontal        = 0
         self.vertical          = 0
+        self.slow              = False
+        self.recorder          = None
+        # Keeps stick drift and jitter from turning into motor writes
+        self.input_filter      = InputFilterClass(self.joystick_settings)
+        # Looks the motor commands up instead of working them out, if NumPy is there to build the table
+        self.mixer             = None
+        self.states            = None
+        if mixer_available():
+            self.mixer = MixerClass(self.joystick_settings, self.power_settings)
 
     def get_battery_details(self):
         """ Returns the battery details """
         return self.mikey_monster.get_battery_details()
 
     def execute_move(self, joystick):
-        """ Reads and executes any valid input """
-        self.manage_event(joystick)
+        """ Reads and executes any valid input, returning whether there was a move to make """
+        if not self.manage_event(joystick):
+            return False
         self.perform_move()
+        return True
 
     def turn_left(self):
         """ Deals with turning left """
-        # If not moving, move
-        if self.vertical > -0.05 and self.vertical < 0.05:
+        # If not moving, move, the input filter has already zeroed the axis inside its deadzone
+        if self.vertical == 0.0:
             self.drive_left  = self.horizontal  * self.power_settings.max_power
             self.drive_right = -self.horizontal * self.power_settings.max_power
         # If moving, take the deduction
@@ -36,8 +61,8 @@ class InputHandlerClass():
 
     def turn_right(self):
         """ Deals with turning right """
-        # If not moving, move
-        if self.vertical > -0.05 and self.vertical < 0.05:
+        # If not moving, move, the input filter has already zeroed the axis inside its deadzone
+        if self.vertical == 0.0:
             self.drive_left    = self.horizontal * self.power_settings.max_power
             self.drive_right = -self.horizontal    * self.power_settings.max_power
         # If moving, take the deduction
@@ -45,20 +70,28 @@ class InputHandlerClass():
             self.drive_right *= 1.0 - (2.0 * self.horizontal)
 
     def manage_event(self, joystick):
-        """ Deal with any inputted event """
+        """ Deal with any inputted event, returning False if nothing changed enough to need a move """
         # Read axis positions (-1 to +1)
         self.get_joystick_inputs(joystick)
+        # Check for button presses
+        self.slow = joystick.get_button(self.joystick_settings.slow_button)
+        self.vertical, self.horizontal, changed = self.input_filter.condition(self.vertical, self.horizontal, self.slow)
+        if not changed:
+            return False
+        if self.mixer:
+            self.states = self.mixer.mix(self.vertical, self.horizontal, self.slow)
+            return True
         self.drive_left = self.drive_right = -self.vertical
         # Deal with turning left
-        if self.horizontal < -0.05:
+        if self.horizontal < 0.0:
             self.turn_left()
         # Turning right
-        elif self.horizontal > 0.05:
+        elif self.horizontal > 0.0:
             self.turn_right()
-        # Check for button presses
-        if joystick.get_button(self.joystick_settings.slow_button):
+        if self.slow:
             self.drive_left  *= self.joystick_settings.slow_factor
             self.drive_right *= self.joystick_settings.slow_factor
+        return True
 
     def get_horizontal_axis(self, joystick):
         """ Sets the self.horizontal axis """
@@ -79,4 +112,31 @@ class InputHandlerClass():
 
     def perform_move(self):
         """ Performs the actual movement """
-        self.mikey_monster.drive(self.drive_left, self.drive_right)
+        if self.states:
+            # The mixer gives motor 1 then motor 2, which are the right then the left side
+            right, left = self.states
+            self.mikey_monster.drive_states(left, right)
+        else:
+            self.mikey_monster.drive(self.drive_left, self.drive_right)
+        if self.recorder:
+            self.record_move()
+
+    def record_move(self):
+        """ Writes the inputs and what was sent to the motors to the flight recorder """
+        mikey_monster = self.mikey_monster
+        if self.states:
+            # The table skips the drive levels, so record the ones the motor commands work out to
+            self.drive_left, self.drive_right = (
+                drive_level(state) / self.power_settings.max_power for state in reversed(self.states)
+            )
+        self.recorder.record(
+            self.vertical,
+            self.horizontal,
+            self.drive_left,
+            self.drive_right,
+            self.slow,
+            mikey_monster.motors.writers[0].states[1],
+            mikey_monster.motors.writers[0].states[2],
+            mikey_monster.thunderborg.errorCount,
+            mikey_monster.telemetry.latest("battery")
+        )
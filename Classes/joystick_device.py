@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Reads the joysticks straight from the Linux joystick devices, without pygame """
+import errno
+import os
+import select
+import struct
+import time
+from   Classes.hotplug import HotplugStatsClass, HotplugWatcherClass
+
+# struct js_event from linux/joystick.h: time, value, type, number
+JS_EVENT         = struct.Struct("<IhBB")
+JS_EVENT_BUTTON  = 0x01
+JS_EVENT_AXIS    = 0x02
+JS_EVENT_INIT    = 0x80
+AXIS_MAX         = 32767.0
+DEFAULT_DEVICE   = "/dev/input/js0"
+# How often to look for a joystick when inotify cannot be used, in seconds
+RETRY_INTERVAL   = 0.1
+
+class JoystickDeviceClass():
+    """ A joystick read from a /dev/input/js* device, or anything else which produces js_event records """
+    def __init__(self, path = DEFAULT_DEVICE, joystick_id = 0, fd = None):
+        """ Opens the device without blocking, or uses an already open fd such as one end of a pipe """
+        self.path        = path
+        self.joystick_id = joystick_id
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        else:
+            os.set_blocking(fd, False)
+        self.fd          = fd
+        self.axes        = {}
+        self.buttons     = {}
+        self.pending     = b""
+        self.connected   = True
+
+    def init(self):
+        """ Nothing to do, the device is ready as soon as it is open """
+        pass
+
+    def get_id(self):
+        """ Returns the joystick id """
+        return self.joystick_id
+
+    def get_axis(self, axis):
+        """ Returns an axis position, from -1 to +1 """
+        return self.axes.get(axis, 0.0)
+
+    def get_button(self, button):
+        """ Returns 1 if the button is pressed, 0 if it is not """
+        return self.buttons.get(button, 0)
+
+    def fileno(self):
+        """ Returns the fd, so the device can be passed to select """
+        return self.fd
+
+    def read_events(self):
+        """ Reads everything waiting, returning True if any axis moved or a button was pressed """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, JS_EVENT.size * 64)
+            except BlockingIOError:
+                break
+            except OSError as ex:
+                if ex.errno != errno.ENODEV:
+                    raise
+                data = b""
+            if not data:
+                # Unplugged, so let go of the sticks rather than keep the last command
+                self.disconnect()
+                return True
+            data         = self.pending + data
+            usable       = len(data) - len(data) % JS_EVENT.size
+            self.pending = data[usable:]
+            for _, value, event_type, number in JS_EVENT.iter_unpack(data[:usable]):
+                if event_type & ~JS_EVENT_INIT == JS_EVENT_AXIS:
+                    self.axes[number] = max(-1.0, value / AXIS_MAX)
+                    changed = True
+                elif event_type & ~JS_EVENT_INIT == JS_EVENT_BUTTON:
+                    self.buttons[number] = 1 if value else 0
+                    # Like pygame, only presses count as events
+                    changed = changed or bool(value)
+        return changed
+
+    def disconnect(self):
+        """ Lets go of the sticks and closes the device, after it has been unplugged """
+        if self.connected:
+            self.connected = False
+            self.axes      = {}
+            self.buttons   = {}
+            self.pending   = b""
+            os.close(self.fd)
+
+    def reopen(self):
+        """ Opens the device again after it has been plugged back in, raising OSError if it cannot be used yet """
+        if not self.connected:
+            self.fd        = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self.connected = True
+
+    def close(self):
+        """ Closes the device """
+        self.disconnect()
+
+class JoystickDeviceInputClass():
+    """ The joystick device backend, which waits on the devices and any hotplug changes with select """
+    idle_timeout  = 0.5
+    # The devices can be waited on from any thread
+    poll_anywhere = True
+
+    def __init__(self, paths = (DEFAULT_DEVICE,)):
+        """ Initialises the variables
+
+        on_removed is called with the joystick when one is unplugged, and on_connected
+        when one comes back, both from whichever thread calls poll
+        """
+        self.paths        = list(paths)
+        self.joysticks    = []
+        self.watcher      = None
+        self.hotplug      = HotplugStatsClass()
+        self.on_removed   = None
+        self.on_connected = None
+
+    def start(self):
+        """ Starts watching for joysticks being plugged in and unplugged """
+        try:
+            self.watcher = HotplugWatcherClass(
+                [os.path.basename(path) for path in self.paths],
+                os.path.dirname(self.paths[0])
+            )
+        except OSError as ex:
+            print("Not watching for joysticks (%s), checking every %.1f s instead" % (ex, RETRY_INTERVAL))
+
+    def connect(self):
+        """ Opens the first joystick device, returning False if it is not there yet """
+        joysticks = self.connect_all(1)
+        return joysticks[0] if joysticks else False
+
+    def connect_all(self, count):
+        """ Opens the first count joystick devices, numbered in order, returning False until they are all there """
+        joysticks = []
+        try:
+            for joystick_id, path in enumerate(self.paths[:count]):
+                joysticks.append(JoystickDeviceClass(path, joystick_id))
+        except OSError:
+            for joystick in joysticks:
+                joystick.close()
+            return False
+        self.joysticks = joysticks
+        return joysticks
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds for a joystick device to appear """
+        if self.watcher is None:
+            time.sleep(min(timeout, RETRY_INTERVAL))
+            return
+        readable, _, _ = select.select([self.watcher], [], [], timeout)
+        if readable:
+            self.watcher.read_changes()
+
+    def add(self, joystick):
+        """ Adds another joystick to wait on """
+        self.joysticks.append(joystick)
+
+    def reset(self):
+        """ Closes the joysticks, so the next connect starts afresh """
+        for joystick in self.joysticks:
+            joystick.close()
+        self.joysticks = []
+
+    @staticmethod
+    def prepare(joystick):
+        """ Gets a joystick ready for use """
+        joystick.init()
+
+    def lost(self, joystick, noticed, moved):
+        """ Deals with a joystick being unplugged, its sticks are zeroed so the next tick stops it too """
+        if joystick.connected:
+            joystick.disconnect()
+        moved.add(joystick.joystick_id)
+        self.hotplug.removed(noticed, self.on_removed, joystick)
+
+    def changed(self, changes, noticed, moved):
+        """ Deals with joystick devices being plugged in or unplugged """
+        for path, present in changes:
+            for joystick in self.joysticks:
+                if joystick.path != path:
+                    continue
+                if not present:
+                    if joystick.connected:
+                        self.lost(joystick, noticed, moved)
+                    continue
+                if joystick.connected:
+                    continue
+                try:
+                    joystick.reopen()
+                except OSError:
+                    # Not usable yet, udev will change the permissions in a moment
+                    continue
+                self.hotplug.reconnected()
+                if self.on_connected:
+                    self.on_connected(joystick)
+
+    def poll(self, timeout):
+        """ Waits up to timeout seconds for events, and returns which joysticks moved """
+        moved    = set()
+        readable = [joystick for joystick in self.joysticks if joystick.connected]
+        if self.watcher is not None:
+            readable.append(self.watcher)
+        elif len(readable) < len(self.joysticks):
+            # Nothing will say when the joystick is back, so keep trying
+            self.changed([(joystick.path, True) for joystick in self.joysticks], time.monotonic(), moved)
+            timeout = min(timeout, RETRY_INTERVAL)
+        if not readable:
+            time.sleep(max(0.0, timeout))
+            return moved, True
+        readable, _, _ = select.select(readable, [], [], max(0.0, timeout))
+        noticed        = time.monotonic()
+        for item in readable:
+            if item is self.watcher:
+                self.changed(self.watcher.read_changes(), noticed, moved)
+            elif not item.connected:
+                # Already dealt with, the watcher saw it go first
+                continue
+            elif item.read_events():
+                if item.connected:
+                    moved.add(item.joystick_id)
+                else:
+                    self.lost(item, noticed, moved)
+        return moved, True
+
+    def report(self):
+        """ Outputs the hotplug statistics """
+        self.hotplug.report()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Keeps a shadow copy of the ThunderBorg LEDs, so only changes are sent and never too often """
+import time
+import Classes.ThunderBorg3 as thunderborg
+
+# The least time between LED writes, in seconds
+LED_INTERVAL = 0.1
+
+def quantise(r, g, b):
+    """ Returns the levels the ThunderBorg would be sent for a colour """
+    return tuple(max(0, min(thunderborg.PWM_MAX, int(level * thunderborg.PWM_MAX))) for level in (r, g, b))
+
+def colour(levels):
+    """ Turns levels back into the colour to pass to the ThunderBorg, the half makes sure they come out the same """
+    return tuple((level + 0.5) / thunderborg.PWM_MAX for level in levels)
+
+class LedStateClass():
+    """ Remembers what the LEDs were last set to, and what they should be, and writes the difference """
+    def __init__(self, board, bus_lock, interval = LED_INTERVAL):
+        """ Initialises the variables
+
+        While deferred is True, changes are only written by flush, such as from the control
+        loop's idle time, otherwise they are written straight away if the rate allows
+        """
+        self.board      = board
+        self.bus_lock   = bus_lock
+        self.interval   = interval
+        self.deferred   = False
+        # None means not known, so the first write always goes out
+        self.sent       = {"led1": None, "led2": None, "battery": None}
+        self.wanted     = dict(self.sent)
+        self.written_at = -interval
+        self.writes     = 0
+        self.unchanged  = 0
+        self.delayed    = 0
+        self.waiting    = False
+
+    def set_leds(self, r, g, b):
+        """ Sets both LEDs to a colour """
+        self.update(led1 = quantise(r, g, b), led2 = quantise(r, g, b))
+
+    def set_led1(self, r, g, b):
+        """ Sets the colour of LED1 """
+        self.update(led1 = quantise(r, g, b))
+
+    def set_led2(self, r, g, b):
+        """ Sets the colour of LED2 """
+        self.update(led2 = quantise(r, g, b))
+
+    def show_battery(self, show):
+        """ Sets whether the LEDs show the battery level """
+        self.update(battery = bool(show))
+
+    def update(self, **wanted):
+        """ Records the new wanted state, and writes it unless deferred """
+        self.wanted.update(wanted)
+        if self.wanted == self.sent:
+            self.unchanged += 1
+            return
+        if not self.deferred:
+            self.flush()
+
+    def flush(self, force = False):
+        """ Writes whatever has changed, unless the last write was too recent, returning whether it wrote """
+        if self.wanted == self.sent:
+            return False
+        now = time.monotonic()
+        if not force and now - self.written_at < self.interval:
+            if not self.waiting:
+                self.waiting  = True
+                self.delayed += 1
+            return False
+        with self.bus_lock:
+            wanted = self.wanted
+            if wanted["battery"] is not None and wanted["battery"] != self.sent["battery"]:
+                self.board.SetLedShowBattery(wanted["battery"])
+                # The board has been colouring the LEDs itself, so their colours are no longer known
+                self.sent = {"led1": None, "led2": None, "battery": wanted["battery"]}
+                self.writes += 1
+            led1, led2 = wanted["led1"], wanted["led2"]
+            if wanted["battery"]:
+                # The board is colouring the LEDs itself, the colours only matter once that is turned off
+                pass
+            elif led1 is not None and led1 == led2 and (led1 != self.sent["led1"] or led2 != self.sent["led2"]):
+                self.board.SetLeds(*colour(led1))
+                self.writes += 1
+            else:
+                if led1 is not None and led1 != self.sent["led1"]:
+                    self.board.SetLed1(*colour(led1))
+                    self.writes += 1
+                if led2 is not None and led2 != self.sent["led2"]:
+                    self.board.SetLed2(*colour(led2))
+                    self.writes += 1
+            self.sent["led1"], self.sent["led2"] = led1, led2
+        self.written_at = now
+        self.waiting    = False
+        return True
+
+    def forget(self):
+        """ Forgets what the LEDs were set to, so the next flush writes everything """
+        self.sent = {"led1": None, "led2": None, "battery": None}
+
+    def report(self):
+        """ Outputs how many LED writes were sent and saved """
+        print("LED writes:")
+        print("  Sent                 %d" % (self.writes))
+        print("  Unchanged            %d" % (self.unchanged))
+        print("  Delayed by the cap   %d" % (self.delayed))
+        print("")
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Measures how much CPU the main loop uses, and how long inputs take to reach the motors """
+import time
+
+class LoopStatsClass():
+    """ Keeps track of the CPU use and event to motor latency of a loop """
+    def __init__(self):
+        """ Initialises the variables """
+        self.wall_start    = time.monotonic()
+        self.cpu_start     = time.process_time()
+        self.events        = 0
+        self.latency_total = 0.0
+        self.latency_max   = 0.0
+
+    def event_handled(self, received):
+        """ Records that an event received at the given monotonic time has reached the motors """
+        latency             = time.monotonic() - received
+        self.events        += 1
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    def cpu_use(self):
+        """ Returns the CPU use since the stats started, as a percentage of one core """
+        wall = time.monotonic() - self.wall_start
+        if wall <= 0:
+            return 0.0
+        return 100.0 * (time.process_time() - self.cpu_start) / wall
+
+    def average_latency(self):
+        """ Returns the average event to motor latency, in seconds """
+        if not self.events:
+            return 0.0
+        return self.latency_total / self.events
+
+    def report(self):
+        """ Outputs the loop statistics """
+        print("Loop statistics:")
+        print("  CPU use              %5.1f %%" % (self.cpu_use()))
+        print("  Events handled       %d" % (self.events))
+        print("  Average latency      %5.2f ms" % (self.average_latency() * 1000.0))
+        print("  Maximum latency      %5.2f ms" % (self.latency_max * 1000.0))
+        print("")
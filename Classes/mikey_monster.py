@@ -1,7 +1,46 @@
 #!/usr/bin/env python3
 # coding: Latin-1
 """ Makes the MonsterBorg remote controllable, using the ThunderBorg library """
+import threading
+import time
 import Classes.ThunderBorg3    as thunderborg
+from   Classes.discovery_cache import DiscoveryCacheClass
+from   Classes.drive_group    import DriveGroupClass
+from   Classes.led_state      import LedStateClass
+from   Classes.motor_writer   import quantise
+from   Classes.telemetry      import TelemetrySamplerClass
+
+# The most seconds to spend scanning each I2C bus when the ThunderBorg is not where expected
+SCAN_TIME_BUDGET  = 2.0
+# The ThunderBorg turns the motors off if it has not been commanded for this long, with the failsafe on
+FAILSAFE_TIMEOUT  = 0.25
+# Resend the motor states after this long without a motor write, leaving a margin for a slow tick
+KEEPALIVE_TIMEOUT = 0.15
+# How often the keepalive should be checked, so a resend is never later than FAILSAFE_TIMEOUT
+KEEPALIVE_CHECK   = 0.05
+# How many times to try changing the failsafe before giving up
+FAILSAFE_ATTEMPTS = 5
+# How reads are retried: backing off from 0.5 ms up to 4 ms, never going on past half a control tick,
+# and refusing reads for a second after 5 reads in a row have failed
+READ_ATTEMPTS     = 4
+READ_BACKOFF      = 0.0005
+READ_BACKOFF_MAX  = 0.004
+READ_DEADLINE     = 0.01
+BREAKER_THRESHOLD = 5
+BREAKER_RESET     = 1.0
+
+def retry_policy():
+    """ Returns a new RetryPolicy for a board, each board needs its own for the circuit breaker """
+    return thunderborg.RetryPolicy(
+        attempts         = READ_ATTEMPTS,
+        backoff          = READ_BACKOFF,
+        backoffMax       = READ_BACKOFF_MAX,
+        jitter           = 0.5,
+        deadline         = READ_DEADLINE,
+        retryErrors      = True,
+        breakerThreshold = BREAKER_THRESHOLD,
+        breakerReset     = BREAKER_RESET
+    )
 
 class MikeyMonsterException(Exception):
     """ Manages any exceptions raised by MikeyMonster """
@@ -24,7 +63,15 @@ class JoystickSettingsClass(object):
         self.slow_button       = slow_button
         self.slow_factor       = 0.5
         self.fast_button       = fast_button
-        self.interval          = 0.00
+        # How far each axis has to be from the centre to count, InputFilterClass zeroes it until then
+        self.deadzone          = 0.05
+        # Radial deadband around the centre, and how much further out the stick has to go to leave it
+        self.deadband          = 0.06
+        self.hysteresis        = 0.02
+        # How far each axis has to move before it counts, about one PWM step
+        self.vertical_step     = 1.0 / thunderborg.PWM_MAX
+        self.horizontal_step   = 1.0 / thunderborg.PWM_MAX
+        self.interval          = 0.02
 
 class PowerSettingsClass(object):
     """ Contains the power settings """
@@ -38,84 +85,244 @@ class PowerSettingsClass(object):
         else:
             self.max_power = self.voltage_out / self.voltage_in
 
+class DriveSettingsClass(object):
+    """ Which ThunderBorg motor outputs make up each side of the robot """
+    def __init__(self, outputs = None):
+        """ outputs is a list of (side, address, motor, reversed), an address of None is the board that was found
+
+        For example a six wheeled build with a second board at 0x16 could use
+        [("left", None, 2, False), ("right", None, 1, False), ("left", 0x16, 2, False), ("right", 0x16, 1, False)]
+        """
+        if outputs is None:
+            # The MonsterBorg has its right side on motor 1 and its left side on motor 2
+            outputs = [("right", None, 1, False), ("left", None, 2, False)]
+        self.outputs = outputs
+
 class MikeyMonsterClass():
     """ Controls the MonsterBorg """
-    def __init__(self, joystick, power):
-        """ Sets up the ThunderBorg, which is used by the MonsterBorg """
+    def __init__(self, joystick, power, drive = None, location = None):
+        """ Sets up the ThunderBorg, which is used by the MonsterBorg, and any others that drive it too
+
+        location is the (bus number, address) of the board, for when several robots are driven
+        at once, otherwise the board is looked for where it was last time and then scanned for
+        """
+        started       = time.monotonic()
         self.failsafe = False
         self.joystick = joystick
         self.power    = power
-        # Setup the ThunderBorg
+        self.outputs  = (drive if drive is not None else DriveSettingsClass()).outputs
+        self.cache    = DiscoveryCacheClass()
+        # Held for each use of the ThunderBorg, so the motor, LED and failsafe commands from different threads do not
+        # interleave, the telemetry has its own handle on the shared bus and does not need it
+        self.bus_lock = threading.RLock()
         self.thunderborg = thunderborg.ThunderBorg()
-        self.thunderborg.Init()
-        # Check that a ThunderBorg chip can be found
-        self._find_chips()
+        if location is not None:
+            # Scanning could find another robot's board, so only use the one asked for
+            self._init_location(location)
+        else:
+            # Setup the ThunderBorg, trying wherever it was last time first
+            if not self._init_cached():
+                self.thunderborg.Init()
+            # Check that a ThunderBorg chip can be found
+            self._find_chips()
+        # The first board does the battery, LEDs and telemetry, the others only drive motors
+        self.outputs = [
+            (side, None if address == self.thunderborg.i2cAddress else address, motor, reversed_motor)
+            for side, address, motor, reversed_motor in self.outputs
+        ]
+        self.boards  = self._init_boards()
         # Set the motors and LEDs off
-        self.thunderborg.MotorsOff()
-        self.thunderborg.SetLedShowBattery(False)
-        self.thunderborg.SetLeds(0,0,1)
+        for board in self.boards.values():
+            board.MotorsOff()
+        self.startup_time = time.monotonic() - started
+        # Only send LED changes, and not too often
+        self.leds = LedStateClass(self.thunderborg, self.bus_lock)
+        self.leds.show_battery(False)
+        self.leds.set_leds(0, 0, 1)
+        self.leds.flush(True)
+        # Only send motor commands which change something, a tick at a time to every board,
+        # keepalive looks after the failsafe so duplicates never need sending while driving
+        self.motors = DriveGroupClass([
+            (side, self.boards[address], motor, reversed_motor)
+            for side, address, motor, reversed_motor in self.outputs
+        ], resend_interval = None)
+        # Reads the battery, drive faults and motors in the background once started
+        self.telemetry = TelemetrySamplerClass(self)
+        self.telemetry.board.retryPolicy = retry_policy()
 
     def drive(self, left, right):
         """ Moves the MikeyMonster """
-        self.thunderborg.SetMotor1(right * self.power.max_power)
-        self.thunderborg.SetMotor2(left  * self.power.max_power)
+        with self.bus_lock:
+            self.motors.set_sides(quantise(left * self.power.max_power), quantise(right * self.power.max_power))
+
+    def drive_states(self, left, right):
+        """ Moves the MikeyMonster, using (direction, pwm) pairs which already include the power limit """
+        with self.bus_lock:
+            self.motors.set_sides(left, right)
 
     def set_leds(self, led1, led2, led3):
         """ Sets the LEDs """
-        self.thunderborg.SetLeds(led1, led2, led3)
+        self.leds.set_leds(led1, led2, led3)
 
     def get_battery_details(self):
         """ Returns the state of the battery """
         battery = {}
-        battery["minimum"], battery["maximum"] = self.thunderborg.GetBatteryMonitoringLimits()
-        battery["current"] = self.thunderborg.GetBatteryReading()
+        with self.bus_lock:
+            battery["minimum"], battery["maximum"] = self.thunderborg.GetBatteryMonitoringLimits()
+            battery["current"] = self.thunderborg.GetBatteryReading()
         return battery
 
+    def set_failsafe(self, state):
+        """ Turns the failsafe on or off on every board, stopping as soon as each confirms it, and returns whether they all did """
+        confirmed = True
+        for board in self.boards.values():
+            confirmed = self._set_board_failsafe(board, state) and confirmed
+        # Set the class's failsafe to match the boards, it is on if any of them might still have it on
+        self.failsafe = state or not confirmed
+        return confirmed
+
+    def _set_board_failsafe(self, board, state):
+        """ Turns the failsafe on or off on one board, returning whether the board confirmed it """
+        for _ in range(FAILSAFE_ATTEMPTS):
+            with self.bus_lock:
+                board.SetCommsFailsafe(state)
+                failsafe = board.GetCommsFailsafe()
+            if failsafe == state:
+                return True
+        return False
+
     def enable_failsafe(self):
         """ Enables the failsafe """
-        failsafe = False
-        # Makes five attempts at enabling the failsafe
-        for index in range(5):
-            # This is just to stop Pylint complaining about an unused variable
-            index = index
-            # Set the failsafe
-            self.thunderborg.SetCommsFailsafe(True)
-            failsafe = self.thunderborg.GetCommsFailsafe()
-        # Set the class's failsafe to match the function failsafe
-        self.failsafe = failsafe
+        return self.set_failsafe(True)
 
     def disable_failsafe(self):
-        """ Enables the failsafe """
-        failsafe = False
-        # Makes five attempts at disabling the failsafe
-        for index in range(5):
-            # This is just to stop Pylint complaining about an unused variable
-            index = index
-            # Set the failsafe
-            self.thunderborg.SetCommsFailsafe(False)
-            failsafe = self.thunderborg.GetCommsFailsafe()
-        # Set the class's failsafe to match the function failsafe
-        self.failsafe = failsafe
+        """ Disables the failsafe """
+        return self.set_failsafe(False)
+
+    def keepalive(self):
+        """ Stops the failsafe tripping while the motors are meant to be running, but nothing has been sent lately
+
+        Any boards a tick ran out of time for are written first, whether or not the failsafe is on
+        """
+        with self.bus_lock:
+            if self.motors.finish():
+                return True
+            if not self.failsafe:
+                return False
+            return self.motors.keepalive(KEEPALIVE_TIMEOUT)
 
     def led_show_battery(self, show = True):
         """ Changes whether the LEDs show the battery status or not """
-        self.thunderborg.SetLedShowBattery(show)
+        self.leds.show_battery(show)
+
+    def stop_motors(self):
+        """ Stops the motors straight away, whatever was last sent """
+        with self.bus_lock:
+            self.motors.stop()
 
     def turn_off(self):
         """ Switches off """
-        self.thunderborg.MotorsOff()
+        self.telemetry.stop()
+        self.stop_motors()
         self.disable_failsafe()
         self.led_show_battery(False)
         self.set_leds(0, 0, 0)
+        self.leds.flush(True)
+
+    def report_errors(self):
+        """ Outputs the failed reads and writes and the retries, for each command, across all of the boards """
+        boards   = list(self.boards.values()) + [self.telemetry.board]
+        errors   = {}
+        retries  = {}
+        for board in boards:
+            for command, count in board.commandErrors.items():
+                errors[command] = errors.get(command, 0) + count
+            for command, count in board.commandRetries.items():
+                retries[command] = retries.get(command, 0) + count
+        policies = [board.retryPolicy for board in boards]
+        print("I2C errors:")
+        print("  Reads                %d" % (sum(board.readCount for board in boards)))
+        print("  Failed               %d" % (sum(board.errorCount for board in boards)))
+        print("  Retries              %d" % (sum(retries.values())))
+        # Replies for the wrong command, which the combined reads of THUNDERBORG_I2C_RDWR avoid
+        print("  Mixed up replies     %d" % (sum(board.readRetries for board in boards)))
+        print("  Out of time          %d" % (sum(policy.deadlineHits for policy in policies)))
+        print("  Breaker trips        %d (%d reads refused)" % (
+            sum(policy.trips for policy in policies), sum(policy.refused for policy in policies)
+        ))
+        for command in sorted(set(errors) | set(retries)):
+            print("  %-20s %d failed, %d retries" % (
+                thunderborg.COMMAND_NAMES.get(command, "%02X" % (command)), errors.get(command, 0), retries.get(command, 0)
+            ))
+        print("")
+
+    def close(self):
+        """ Lets go of the I2C bus, which is only closed once nothing else is sharing it """
+        self.telemetry.close()
+        with self.bus_lock:
+            for board in self.boards.values():
+                board.Close()
+
+    def _init_boards(self):
+        """ Returns the boards named in the drive settings by address, with None for the one already found """
+        boards = {None: self.thunderborg}
+        for _, address, _, _ in self.outputs:
+            if address in boards:
+                continue
+            board            = thunderborg.ThunderBorg()
+            board.busNumber  = self.thunderborg.busNumber
+            board.i2cAddress = address
+            board.Init()
+            if not board.foundChip:
+                raise MikeyMonsterException("No ThunderBorg at %02X (bus %d) to drive with" % (address, board.busNumber))
+            boards[address] = board
+        # Finding the boards keeps to the plain retries, the backoff and circuit breaker are for driving
+        for board in boards.values():
+            board.retryPolicy = retry_policy()
+        return boards
+
+    def _init_location(self, location):
+        """ Initialises the ThunderBorg at a given bus and address, raising MikeyMonsterException if it is not there """
+        self.thunderborg.busNumber, self.thunderborg.i2cAddress = location
+        self.thunderborg.Init()
+        if not self.thunderborg.foundChip:
+            raise MikeyMonsterException("No ThunderBorg at %02X (bus %d)" % (location[1], location[0]))
+
+    def _init_cached(self):
+        """ Initialises the ThunderBorg where it was found last time, returning whether it is there """
+        cached = self.cache.load()
+        if cached is None or cached[2] != thunderborg.I2C_ID_THUNDERBORG:
+            return False
+        self.thunderborg.busNumber, self.thunderborg.i2cAddress = cached[0], cached[1]
+        self.thunderborg.Init()
+        if self.thunderborg.foundChip:
+            return True
+        # The board has moved, so go back to the defaults
+        self.thunderborg.busNumber  = thunderborg.ThunderBorg.busNumber
+        self.thunderborg.i2cAddress = thunderborg.ThunderBorg.i2cAddress
+        return False
 
     def _find_chips(self):
-        """ Scans for ThunderBorgs """
+        """ Scans for ThunderBorgs, if one is not where expected, and remembers where it is """
         if not self.thunderborg.foundChip:
-            boards = thunderborg.ScanForThunderBorg()
+            buses = thunderborg.ScanBusesForThunderBorg(timeBudget = SCAN_TIME_BUDGET)
+            found = [
+                (bus_number, address)
+                for bus_number, addresses in sorted(buses.items(), reverse = True)
+                for address in addresses
+            ]
             # If no board was found, state so
-            if not boards:
+            if not found:
                 raise MikeyMonsterException("No ThunderBorg boards found")
-            else:
-                error = "No ThunderBorg at address " + self.thunderborg.i2cAddress +", but at: "
-                error = error + ", ".join(boards)
+            print("No ThunderBorg at address %02X, using the one at %02X (bus %d)" % (
+                self.thunderborg.i2cAddress, found[0][1], found[0][0]
+            ))
+            self.thunderborg.busNumber, self.thunderborg.i2cAddress = found[0]
+            self.thunderborg.Init()
+            if not self.thunderborg.foundChip:
+                error = "Could not use the ThunderBorg at: "
+                error = error + ", ".join("%02X (bus %d)" % (address, bus_number) for bus_number, address in found)
                 raise MikeyMonsterException(error)
+        cached = (self.thunderborg.busNumber, self.thunderborg.i2cAddress, thunderborg.I2C_ID_THUNDERBORG)
+        if self.cache.load() != cached:
+            self.cache.save(*cached)
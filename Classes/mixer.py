@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Turns the stick positions straight into motor commands, using a table built once with NumPy """
+from   bisect import bisect_right
+import Classes.ThunderBorg3 as thunderborg
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Roughly how many cells each axis is split into
+CELLS = 512
+
+def mixer_available():
+    """ Returns whether NumPy is there to build the table with """
+    return numpy is not None
+
+def mix_levels(vertical, horizontal, slow, joystick_settings, power_settings):
+    """ Mixes arrays of stick positions into motor 1 and motor 2 drive levels, the same way as InputHandlerClass
+
+    The positions come from InputFilterClass, which has already zeroed any axis inside its deadzone
+    """
+    vertical   = numpy.asarray(vertical, dtype = float)
+    horizontal = numpy.asarray(horizontal, dtype = float)
+    max_power  = power_settings.max_power
+    still      = vertical == 0.0
+    left_turn  = horizontal < 0.0
+    right_turn = horizontal > 0.0
+    spin       = (left_turn | right_turn) & still
+    # Tank drive straight from the vertical stick
+    left       = numpy.where(spin, horizontal * max_power, -vertical)
+    right      = numpy.where(spin, -horizontal * max_power, -vertical)
+    # Turning while moving slows down one side
+    left       = numpy.where(left_turn & ~still, left * (1.0 + 2.0 * horizontal), left)
+    right      = numpy.where(right_turn & ~still, right * (1.0 - 2.0 * horizontal), right)
+    factor     = numpy.where(numpy.asarray(slow, dtype = bool), joystick_settings.slow_factor, 1.0)
+    # MikeyMonsterClass.drive sends the right side to motor 1
+    return right * factor * max_power, left * factor * max_power
+
+def quantise_levels(levels):
+    """ Returns the directions and PWM levels the ThunderBorg would be sent for an array of drive levels """
+    levels    = numpy.asarray(levels, dtype = float)
+    direction = numpy.where(levels < 0, thunderborg.COMMAND_VALUE_REV, thunderborg.COMMAND_VALUE_FWD)
+    pwm       = numpy.minimum(thunderborg.PWM_MAX, (thunderborg.PWM_MAX * numpy.abs(levels)).astype(int))
+    return direction.astype(numpy.uint8), pwm.astype(numpy.uint8)
+
+def cell_edges(cells = CELLS):
+    """ Returns where the cells along an axis start, exactly zero gets a cell of its own as the mix changes either side of it """
+    half          = max(1, cells // 2)
+    positive      = numpy.linspace(0.0, 1.0, half, endpoint = False)
+    # The first positive cell starts just past zero, leaving zero on its own
+    positive[0]   = numpy.nextafter(0.0, 1.0)
+    return numpy.concatenate([numpy.linspace(-1.0, 0.0, half, endpoint = False), [0.0], positive])
+
+class MixerClass():
+    """ Looks up the (direction, pwm) for both motors from the stick positions and the slow button """
+    def __init__(self, joystick_settings, power_settings):
+        """ Builds the table for the settings, which must not change afterwards """
+        self.joystick_settings = joystick_settings
+        self.power_settings    = power_settings
+        edges                  = cell_edges()
+        # Each cell is worked out at its middle, the ends stretch out to cover anything past -1 or +1
+        middles                = (edges + numpy.append(edges[1:], 1.0)) / 2.0
+        middles[edges == 0.0]  = 0.0
+        side                   = len(edges)
+        vertical, horizontal   = numpy.meshgrid(middles, middles, indexing = "ij")
+        # Slow button, vertical cell, horizontal cell, then direction 1, pwm 1, direction 2, pwm 2
+        self.table             = numpy.empty((2, side, side, 4), dtype = numpy.uint8)
+        for slow in (0, 1):
+            for offset, levels in zip((0, 2), mix_levels(vertical, horizontal, slow, joystick_settings, power_settings)):
+                self.table[slow, :, :, offset], self.table[slow, :, :, offset + 1] = quantise_levels(levels)
+        self.edges             = edges
+        # bisect_right gives 0 to side, turn that straight into the offset of the entry, so a lookup is two additions
+        cells                  = [max(0, min(side - 1, index - 1)) for index in range(side + 1)]
+        self.edge_list         = edges.tolist()
+        self.rows              = [cell * side * 4 for cell in cells]
+        self.columns           = [cell * 4 for cell in cells]
+        self.slow_offset       = side * side * 4
+        # Indexing bytes gives plain ints, which is much quicker than going through NumPy for one entry,
+        # and the table shares the same memory for mix_batch
+        self.lookup            = self.table.tobytes()
+        self.table             = numpy.frombuffer(self.lookup, dtype = numpy.uint8).reshape(self.table.shape)
+
+    def mix(self, vertical, horizontal, slow):
+        """ Returns the (direction, pwm) for motor 1 and motor 2 """
+        edges  = self.edge_list
+        index  = self.rows[bisect_right(edges, vertical)] + self.columns[bisect_right(edges, horizontal)]
+        if slow:
+            index += self.slow_offset
+        lookup = self.lookup
+        return (lookup[index], lookup[index + 1]), (lookup[index + 2], lookup[index + 3])
+
+    def mix_batch(self, vertical, horizontal, slow, exact = False):
+        """ Mixes whole arrays of inputs, returning an (n, 4) array of direction 1, pwm 1, direction 2, pwm 2
+
+        With exact set the levels are worked out from the positions themselves instead of
+        looked up, which shows how far the table is from the original maths
+        """
+        vertical   = numpy.asarray(vertical, dtype = float)
+        horizontal = numpy.asarray(horizontal, dtype = float)
+        slow       = numpy.broadcast_to(numpy.asarray(slow, dtype = bool), vertical.shape)
+        if exact:
+            levels = mix_levels(vertical, horizontal, slow, self.joystick_settings, self.power_settings)
+            return numpy.stack(quantise_levels(levels[0]) + quantise_levels(levels[1]), axis = -1)
+        last             = len(self.edges) - 1
+        vertical_index   = numpy.clip(numpy.searchsorted(self.edges, vertical, side = "right") - 1, 0, last)
+        horizontal_index = numpy.clip(numpy.searchsorted(self.edges, horizontal, side = "right") - 1, 0, last)
+        return self.table[slow.astype(int), vertical_index, horizontal_index]
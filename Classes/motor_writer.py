@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Skips motor writes which would not change what the ThunderBorg is already doing """
+import time
+import Classes.ThunderBorg3    as thunderborg
+
+def quantise(power):
+    """ Returns the (direction, pwm) the ThunderBorg would be sent for a drive level """
+    if power < 0:
+        return thunderborg.COMMAND_VALUE_REV, min(thunderborg.PWM_MAX, int(thunderborg.PWM_MAX * -power))
+    return thunderborg.COMMAND_VALUE_FWD, min(thunderborg.PWM_MAX, int(thunderborg.PWM_MAX * power))
+
+def level(state):
+    """ Returns a drive level which the ThunderBorg turns back into exactly this (direction, pwm) """
+    direction, pwm = state
+    # The half makes sure truncating it on the board gives the same pwm
+    power = (pwm + 0.5) / thunderborg.PWM_MAX
+    return -power if direction == thunderborg.COMMAND_VALUE_REV else power
+
+class MotorWriterClass():
+    """ Remembers the last command sent to each motor, and suppresses duplicates """
+    def __init__(self, board, resend_interval = 0.1):
+        """ Sets up the shadow copy of the motor states
+
+        resend_interval is how long, in seconds, a duplicate is suppressed for before it gets
+        sent anyway, which keeps traffic going to the board's comms failsafe, None never sends
+        duplicates, for when keepalive is looking after the failsafe instead
+        """
+        self.board           = board
+        self.resend_interval = float("inf") if resend_interval is None else resend_interval
+        self.setters         = {1: board.SetMotor1, 2: board.SetMotor2}
+        self.states          = {1: None, 2: None}
+        self.sent_at         = {1: 0.0, 2: 0.0}
+        self.sent            = 0
+        self.suppressed      = 0
+        self.combined        = 0
+        self.keepalives      = 0
+
+    def set_state(self, motor, state):
+        """ Sets the (direction, pwm) for motor 1 or 2, if it has changed """
+        now = time.monotonic()
+        if state == self.states[motor] and now - self.sent_at[motor] < self.resend_interval:
+            self.suppressed += 1
+            return
+        self.setters[motor](level(state))
+        self.states[motor]  = state
+        self.sent_at[motor] = now
+        self.sent          += 1
+
+    def set_states(self, state1, state2):
+        """ Sets the (direction, pwm) for both motors, using a single write when they match """
+        if state1 != state2:
+            self.set_state(1, state1)
+            self.set_state(2, state2)
+            return
+        now = time.monotonic()
+        if (state1 == self.states[1] and now - self.sent_at[1] < self.resend_interval and
+                state1 == self.states[2] and now - self.sent_at[2] < self.resend_interval):
+            self.suppressed += 1
+            return
+        # Both motors get the same bytes, so one all motors command does the job
+        self.board.SetMotors(level(state1))
+        self.states[1]  = self.states[2]  = state1
+        self.sent_at[1] = self.sent_at[2] = now
+        self.sent      += 1
+        self.combined  += 1
+
+    def keepalive(self, timeout):
+        """ Resends the motor states if a motor is running and nothing has been sent for timeout seconds
+
+        Returns True if anything was sent, stopped motors are left alone as the failsafe
+        tripping would not change anything
+        """
+        states  = self.states
+        running = any(state is not None and state[1] for state in states.values())
+        if not running or time.monotonic() - max(self.sent_at.values()) < timeout:
+            return False
+        self.keepalives += 1
+        # Bypass the duplicate check, resending the same state is the point
+        self.states = {1: None, 2: None}
+        self.set_states(states[1] or quantise(0), states[2] or quantise(0))
+        return True
+
+    def forget(self):
+        """ Forgets the motor states, so the next commands are always sent """
+        self.states = {1: None, 2: None}
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Reads the joysticks through pygame """
+import math
+import os
+import select
+import time
+import pygame
+from   Classes.hotplug import HotplugStatsClass, HotplugWatcherClass
+
+# Posted by the hotplug watcher thread, to wake the main loop when something in /dev/input changes
+HOTPLUG_EVENT    = pygame.USEREVENT + 1
+# Posted once SDL itself has seen a joystick come or go, SDL 1 has no such events
+DEVICE_EVENTS    = [getattr(pygame, name) for name in ("JOYDEVICEADDED", "JOYDEVICEREMOVED") if hasattr(pygame, name)]
+# The only events the main loop cares about, everything else is left out of the queue
+HANDLED_EVENTS   = [pygame.QUIT, pygame.JOYBUTTONDOWN, pygame.JOYAXISMOTION, HOTPLUG_EVENT] + DEVICE_EVENTS
+# How long to block waiting for an event before checking in again, in milliseconds
+EVENT_TIMEOUT_MS = 500
+# How often to look for a joystick when inotify cannot be used, in seconds
+RETRY_INTERVAL   = 0.1
+
+def had_event(event):
+    """ Check that there has been a valid event """
+    running    = True
+    temp_event = False
+    # print(event)
+    if event.type == pygame.QUIT:
+        running = False
+    elif event.type == pygame.JOYBUTTONDOWN:
+        temp_event = True
+    elif event.type == pygame.JOYAXISMOTION:
+        temp_event = True
+    return temp_event, running
+
+def wait_for_events(timeout = EVENT_TIMEOUT_MS):
+    """ Blocks until there are events, or the timeout passes, and returns them """
+    if timeout <= 0:
+        # A zero timeout makes pygame wait forever, so just take what is already queued
+        return pygame.event.get()
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    # Grab anything else that arrived at the same time
+    return [event] + pygame.event.get()
+
+class PygameInputClass():
+    """ The pygame joystick backend """
+    idle_timeout  = EVENT_TIMEOUT_MS / 1000.0
+    # pygame has to be polled from the thread that started it
+    poll_anywhere = False
+
+    def __init__(self):
+        """ Initialises the variables
+
+        on_removed is called with each joystick when one is unplugged, and on_connected with
+        each new joystick object whenever pygame has to be asked for them again
+        """
+        self.joysticks    = []
+        self.ids          = []
+        self.count        = 1
+        self.watcher      = None
+        self.hotplug      = HotplugStatsClass()
+        self.on_removed   = None
+        self.on_connected = None
+
+    def start(self):
+        """ Starts pygame, without a window, and watches for joysticks being plugged in and unplugged """
+        # Remove the need for a GUI window
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.init()
+        # Only wake up for the events that are actually handled
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(HANDLED_EVENTS)
+        try:
+            # SDL may use either interface, so watch both
+            self.watcher = HotplugWatcherClass(["js*", "event*"])
+        except OSError as ex:
+            print("Not watching for joysticks (%s), checking every %.1f s instead" % (ex, RETRY_INTERVAL))
+
+    def connect(self):
+        """ Returns the first joystick, or False if there is not one """
+        joysticks = self.connect_all(1)
+        return joysticks[0] if joysticks else False
+
+    def connect_all(self, count):
+        """ Returns the first count joysticks, in pygame's order, or False until there are that many """
+        self.count = count
+        pygame.joystick.init()
+        if pygame.joystick.get_count() < count:
+            pygame.joystick.quit()
+            return False
+        self.joysticks = [pygame.joystick.Joystick(index) for index in range(count)]
+        self.ids       = self.attached() if DEVICE_EVENTS else []
+        return self.joysticks
+
+    def attached(self):
+        """ Returns the instance ids of the joysticks pygame can see now, up to the number in use """
+        count = min(self.count, pygame.joystick.get_count())
+        return [pygame.joystick.Joystick(index).get_instance_id() for index in range(count)]
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds for an input device to appear """
+        if self.watcher is None:
+            time.sleep(min(timeout, RETRY_INTERVAL))
+            return
+        readable, _, _ = select.select([self.watcher], [], [], timeout)
+        if readable:
+            self.watcher.read_changes()
+
+    def reset(self):
+        """ Drops any joysticks, so the next connect starts afresh """
+        self.joysticks = []
+        self.ids       = []
+        pygame.joystick.quit()
+
+    def prepare(self, joystick):
+        """ Gets a joystick ready for use, and from now on wakes the main loop when something is plugged in or out """
+        joystick.init()
+        if self.watcher is not None:
+            self.watcher.start(self.post_changes)
+
+    @staticmethod
+    def post_changes(changes):
+        """ Wakes the main loop, pygame events can be posted from any thread """
+        pygame.event.post(pygame.event.Event(HOTPLUG_EVENT, noticed = time.monotonic(), changes = changes))
+
+    def rescan(self, noticed, moved):
+        """ Asks pygame for the joysticks again, if the ones in use have changed
+
+        Most changes in /dev/input are other devices, or the other interface of the same
+        joystick, so the joysticks in use are left alone unless pygame sees a different set.
+        pygame numbers the joysticks afresh each time, so once one has gone the others could
+        be numbered differently, every robot is stopped until there are enough joysticks again
+        """
+        # SDL 1 only notices joysticks coming and going when it starts again
+        if self.joysticks and DEVICE_EVENTS and self.attached() == self.ids:
+            return
+        had_joysticks  = self.joysticks
+        pygame.joystick.quit()
+        self.joysticks = []
+        joysticks      = self.connect_all(self.count)
+        if not joysticks:
+            for joystick in had_joysticks:
+                self.hotplug.removed(noticed, self.on_removed, joystick)
+            return
+        for joystick in joysticks:
+            self.prepare(joystick)
+            if not had_joysticks:
+                self.hotplug.reconnected()
+            if self.on_connected:
+                self.on_connected(joystick)
+            # Read the sticks afresh
+            moved.add(joystick.get_id())
+
+    def poll(self, timeout):
+        """ Waits up to timeout seconds for events, and returns which joysticks moved """
+        moved   = set()
+        running = True
+        noticed = None
+        if self.watcher is None and not self.joysticks:
+            # Nothing will say when the joystick is back, so keep trying
+            noticed = time.monotonic()
+            timeout = min(timeout, RETRY_INTERVAL)
+        for event in wait_for_events(int(math.ceil(timeout * 1000))):
+            if event.type == HOTPLUG_EVENT:
+                noticed = event.noticed if noticed is None else min(noticed, event.noticed)
+                continue
+            if event.type in DEVICE_EVENTS:
+                # The watcher may have spotted the device node before SDL caught up, so look again
+                noticed = time.monotonic() if noticed is None else noticed
+                continue
+            was_event, still_running = had_event(event)
+            if was_event:
+                moved.add(event.joy)
+            running = running and still_running
+        if noticed is not None:
+            self.rescan(noticed, moved)
+        return moved, running
+
+    def report(self):
+        """ Outputs the hotplug statistics """
+        self.hotplug.report()
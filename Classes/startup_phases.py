@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Times the startup phases, so the slow ones can be run at the same time as each other """
+import contextlib
+import threading
+import time
+
+class BackgroundStepClass():
+    """ Runs a startup step on its own thread, keeping whatever it returns or raises """
+    def __init__(self, function, *args):
+        """ Starts the step """
+        self.value    = None
+        self.error    = None
+        self.finished = threading.Event()
+        self.thread   = threading.Thread(target = self._run, args = (function,) + args, daemon = True)
+        self.thread.start()
+
+    def _run(self, function, *args):
+        """ Runs the step, catching anything it raises so the main thread can deal with it """
+        try:
+            self.value = function(*args)
+        except BaseException as ex: # pylint: disable=W0703
+            self.error = ex
+        finally:
+            self.finished.set()
+
+    def result(self, timeout = None):
+        """ Waits up to timeout seconds, returning None if the step has not finished and raising its exception if it failed """
+        if not self.finished.wait(timeout):
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class StartupPhasesClass():
+    """ Records when each startup phase started and finished, from whichever thread ran it """
+    def __init__(self):
+        """ Initialises the variables """
+        self.started = time.monotonic()
+        self.phases  = []
+        self.lock    = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Times the code inside the with block as the named phase """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, start - self.started, time.monotonic() - self.started))
+
+    def background(self, function, *args):
+        """ Runs function(*args) on another thread, returning a BackgroundStepClass to collect it from """
+        return BackgroundStepClass(function, *args)
+
+    def elapsed(self):
+        """ Returns the seconds since startup began """
+        return time.monotonic() - self.started
+
+    def report(self):
+        """ Outputs how long each phase took, and when it ran """
+        print("Startup phases:")
+        with self.lock:
+            phases = sorted(self.phases, key = lambda phase: phase[1])
+        for name, start, end in phases:
+            print("  %-20s %6.3f s  (%.3f - %.3f s)" % (name, end - start, start, end))
+        print("  Ready to drive       %6.3f s" % (self.elapsed()))
+        print("")
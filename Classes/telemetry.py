@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Samples the battery, drive faults and motor readback in the background """
+import math
+import threading
+import time
+from   array import array
+import Classes.ThunderBorg3 as thunderborg
+
+# How often each channel is read by default, in Hz, 0 turns a channel off
+DEFAULT_RATES = {
+    "battery": 1.0,
+    "fault1":  2.0,
+    "fault2":  2.0,
+    "motor1":  5.0,
+    "motor2":  5.0
+}
+
+class RingBufferClass():
+    """ A fixed size buffer of timestamped samples, the oldest are overwritten when it is full """
+    def __init__(self, size = 600):
+        """ Allocates the whole buffer up front """
+        self.size   = size
+        self.times  = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.index  = 0
+        self.count  = 0
+
+    def append(self, timestamp, value):
+        """ Adds a sample """
+        self.times[self.index]  = timestamp
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def latest(self):
+        """ Returns the newest (time, value), or None if there are no samples """
+        if not self.count:
+            return None
+        index = (self.index - 1) % self.size
+        return self.times[index], self.values[index]
+
+    def window(self, seconds, now = None):
+        """ Returns the count, minimum, maximum and mean of the samples from the last few seconds """
+        if now is None:
+            now = time.monotonic()
+        count   = 0
+        total   = 0.0
+        minimum = math.inf
+        maximum = -math.inf
+        index   = self.index
+        for _ in range(self.count):
+            index = (index - 1) % self.size
+            if now - self.times[index] > seconds:
+                break
+            value    = self.values[index]
+            count   += 1
+            total   += value
+            minimum  = min(minimum, value)
+            maximum  = max(maximum, value)
+        if not count:
+            return {"count": 0, "minimum": None, "maximum": None, "mean": None}
+        return {"count": count, "minimum": minimum, "maximum": maximum, "mean": total / count}
+
+class TelemetrySamplerClass():
+    """ Reads the telemetry channels at their own rates, on a background thread
+
+    Something else can do the reading instead of start(), by calling sample() for each of due_channels()
+    and waiting next_wait() in between, such as AsyncRuntimeClass on its I2C worker
+    """
+    def __init__(self, mikey_monster, rates = None, size = 600):
+        """ Sets up a ring buffer for each channel
+
+        The readings go through a handle of their own on the shared bus, rather than holding the
+        MikeyMonster's bus lock, so the bus can put motor commands ahead of them
+        """
+        board          = thunderborg.ThunderBorg()
+        board.InitBusOnly(mikey_monster.thunderborg.busNumber, mikey_monster.thunderborg.i2cAddress)
+        self.board     = board
+        self.rates     = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.readers   = {
+            "battery": board.GetBatteryReading,
+            "fault1":  board.GetDriveFault1,
+            "fault2":  board.GetDriveFault2,
+            "motor1":  board.GetMotor1,
+            "motor2":  board.GetMotor2
+        }
+        self.buffers   = dict((name, RingBufferClass(size)) for name in self.readers)
+        self.due       = dict((name, 0.0) for name in self.readers)
+        self.failures  = 0
+        self.stopping  = threading.Event()
+        self.thread    = None
+
+    def start(self):
+        """ Starts sampling """
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target = self._run, name = "telemetry", daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        """ Stops sampling """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """ Stops sampling, and lets go of the bus """
+        self.stop()
+        self.board.Close()
+
+    def latest(self, name):
+        """ Returns the newest value for a channel, or None if it has not been read yet """
+        sample = self.buffers[name].latest()
+        return None if sample is None else sample[1]
+
+    def window(self, name, seconds):
+        """ Returns the count, minimum, maximum and mean of a channel over the last few seconds """
+        return self.buffers[name].window(seconds)
+
+    def sample(self, name):
+        """ Reads a channel once, in between whatever else is using the bus """
+        value = self.readers[name]()
+        if value is None:
+            # The ThunderBorg functions return None when the read fails
+            self.failures += 1
+            return
+        self.buffers[name].append(time.monotonic(), float(value))
+
+    def due_channels(self):
+        """ Returns the channels which are due to be read, and moves them on to their next reading """
+        now = time.monotonic()
+        due = []
+        for name, rate in self.rates.items():
+            if rate > 0 and now >= self.due[name]:
+                due.append(name)
+                self.due[name] = max(self.due[name] + 1.0 / rate, now)
+        return due
+
+    def next_wait(self):
+        """ Returns how long until the next channel is due, in seconds, at most one second """
+        now  = time.monotonic()
+        wait = 1.0
+        for name, rate in self.rates.items():
+            if rate > 0:
+                wait = min(wait, self.due[name] - now)
+        return max(0.0, wait)
+
+    def _run(self):
+        """ Reads each channel when it is due, until stopped """
+        while not self.stopping.is_set():
+            for name in self.due_channels():
+                self.sample(name)
+            self.stopping.wait(self.next_wait())
+
+    def report(self, seconds = 60.0):
+        """ Outputs a summary of the recent telemetry """
+        battery = self.window("battery", seconds)
+        faults  = self.window("fault1", seconds)["maximum"] or self.window("fault2", seconds)["maximum"]
+        print("Telemetry over the last %d s:" % (seconds))
+        if battery["count"]:
+            print("  Battery              %02.2f V (lowest %02.2f V)" % (self.latest("battery"), battery["minimum"]))
+        print("  Drive faults         %s" % ("yes" if faults else "no"))
+        print("  Failed reads         %d" % (self.failures))
+        print("")
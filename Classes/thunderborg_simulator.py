@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Simulates ThunderBorg boards on an I2C bus, so everything can run without the hardware """
+import errno
+import random
+import threading
+import time
+import Classes.ThunderBorg3    as thunderborg
+
+class ThunderBorgSimulatorClass():
+    """ Models the registers and replies of the ThunderBorg firmware """
+    def __init__(self, address = thunderborg.I2C_ID_THUNDERBORG, voltage = 11.4):
+        """ Sets the board up in its power on state """
+        self.address          = address
+        self.voltage          = voltage
+        self.led1             = [0, 0, 0]
+        self.led2             = [0, 0, 0]
+        self.led_battery      = thunderborg.COMMAND_VALUE_ON
+        self.motor_a          = [thunderborg.COMMAND_VALUE_FWD, 0]
+        self.motor_b          = [thunderborg.COMMAND_VALUE_FWD, 0]
+        self.drive_fault_a    = thunderborg.COMMAND_VALUE_OFF
+        self.drive_fault_b    = thunderborg.COMMAND_VALUE_OFF
+        self.failsafe         = thunderborg.COMMAND_VALUE_OFF
+        self.failsafe_trips   = 0
+        self.last_command     = time.monotonic()
+        self.battery_limits   = [
+            int(thunderborg.BATTERY_MIN_DEFAULT / thunderborg.VOLTAGE_PIN_MAX * 0xFF),
+            int(thunderborg.BATTERY_MAX_DEFAULT / thunderborg.VOLTAGE_PIN_MAX * 0xFF)
+        ]
+        self.external_leds    = []
+        self.reply            = bytes(thunderborg.I2C_MAX_LEN)
+        self.writes           = 0
+        self.reads            = 0
+        self.handlers         = {
+            thunderborg.COMMAND_SET_LED1:           self._set_led1,
+            thunderborg.COMMAND_GET_LED1:           lambda data: self.led1,
+            thunderborg.COMMAND_SET_LED2:           self._set_led2,
+            thunderborg.COMMAND_GET_LED2:           lambda data: self.led2,
+            thunderborg.COMMAND_SET_LEDS:           self._set_leds,
+            thunderborg.COMMAND_SET_LED_BATT_MON:   self._set_led_battery,
+            thunderborg.COMMAND_GET_LED_BATT_MON:   lambda data: [self.led_battery],
+            thunderborg.COMMAND_SET_A_FWD:          lambda data: self._set_motor(self.motor_a, thunderborg.COMMAND_VALUE_FWD, data),
+            thunderborg.COMMAND_SET_A_REV:          lambda data: self._set_motor(self.motor_a, thunderborg.COMMAND_VALUE_REV, data),
+            thunderborg.COMMAND_GET_A:              lambda data: self.motor_a,
+            thunderborg.COMMAND_SET_B_FWD:          lambda data: self._set_motor(self.motor_b, thunderborg.COMMAND_VALUE_FWD, data),
+            thunderborg.COMMAND_SET_B_REV:          lambda data: self._set_motor(self.motor_b, thunderborg.COMMAND_VALUE_REV, data),
+            thunderborg.COMMAND_GET_B:              lambda data: self.motor_b,
+            thunderborg.COMMAND_ALL_OFF:            self._all_off,
+            thunderborg.COMMAND_GET_DRIVE_A_FAULT:  lambda data: [self.drive_fault_a],
+            thunderborg.COMMAND_GET_DRIVE_B_FAULT:  lambda data: [self.drive_fault_b],
+            thunderborg.COMMAND_SET_ALL_FWD:        lambda data: self._set_all(thunderborg.COMMAND_VALUE_FWD, data),
+            thunderborg.COMMAND_SET_ALL_REV:        lambda data: self._set_all(thunderborg.COMMAND_VALUE_REV, data),
+            thunderborg.COMMAND_SET_FAILSAFE:       self._set_failsafe,
+            thunderborg.COMMAND_GET_FAILSAFE:       lambda data: [self.failsafe],
+            thunderborg.COMMAND_GET_BATT_VOLT:      self._get_battery,
+            thunderborg.COMMAND_SET_BATT_LIMITS:    self._set_battery_limits,
+            thunderborg.COMMAND_GET_BATT_LIMITS:    lambda data: self.battery_limits,
+            thunderborg.COMMAND_WRITE_EXTERNAL_LED: self._write_external_led,
+            thunderborg.COMMAND_GET_ID:             lambda data: [thunderborg.I2C_ID_THUNDERBORG],
+            thunderborg.COMMAND_SET_I2C_ADD:        self._set_address
+        }
+
+    def write(self, data):
+        """ Handles a write transaction, GET commands prepare the reply for the next read """
+        self._check_failsafe()
+        self.writes += 1
+        if not data:
+            return
+        command = data[0]
+        handler = self.handlers.get(command)
+        if handler is None:
+            return
+        self.last_command = time.monotonic()
+        values = handler(bytes(data[1:]))
+        if values is not None:
+            reply = bytearray(thunderborg.I2C_MAX_LEN)
+            reply[0] = command
+            reply[1:1 + len(values)] = bytes(values)
+            self.reply = bytes(reply)
+
+    def read(self, length):
+        """ Handles a read transaction, returning the reply to the last GET command """
+        self._check_failsafe()
+        self.reads += 1
+        return self.reply[:length] + bytes(max(0, length - len(self.reply)))
+
+    def _check_failsafe(self):
+        """ Turns the motors off if the failsafe is on and commands have stopped arriving """
+        if self.failsafe != thunderborg.COMMAND_VALUE_ON:
+            return
+        if time.monotonic() - self.last_command < 0.25:
+            return
+        if self.motor_a[1] or self.motor_b[1]:
+            self.failsafe_trips += 1
+        self.motor_a[:] = [thunderborg.COMMAND_VALUE_FWD, 0]
+        self.motor_b[:] = [thunderborg.COMMAND_VALUE_FWD, 0]
+
+    def _set_led1(self, data):
+        """ COMMAND_SET_LED1 """
+        self.led1 = list(data[:3])
+
+    def _set_led2(self, data):
+        """ COMMAND_SET_LED2 """
+        self.led2 = list(data[:3])
+
+    def _set_leds(self, data):
+        """ COMMAND_SET_LEDS """
+        self.led1 = list(data[:3])
+        self.led2 = list(data[:3])
+
+    def _set_led_battery(self, data):
+        """ COMMAND_SET_LED_BATT_MON """
+        self.led_battery = data[0]
+
+    @staticmethod
+    def _set_motor(motor, direction, data):
+        """ COMMAND_SET_A_FWD, COMMAND_SET_A_REV, COMMAND_SET_B_FWD and COMMAND_SET_B_REV """
+        motor[:] = [direction, data[0]]
+
+    def _set_all(self, direction, data):
+        """ COMMAND_SET_ALL_FWD and COMMAND_SET_ALL_REV """
+        self._set_motor(self.motor_a, direction, data)
+        self._set_motor(self.motor_b, direction, data)
+
+    def _all_off(self, data):
+        """ COMMAND_ALL_OFF """
+        self.motor_a[:] = [thunderborg.COMMAND_VALUE_FWD, 0]
+        self.motor_b[:] = [thunderborg.COMMAND_VALUE_FWD, 0]
+
+    def _set_failsafe(self, data):
+        """ COMMAND_SET_FAILSAFE """
+        self.failsafe = data[0]
+
+    def _get_battery(self, data):
+        """ COMMAND_GET_BATT_VOLT """
+        raw = (self.voltage - thunderborg.VOLTAGE_PIN_CORRECTION) / thunderborg.VOLTAGE_PIN_MAX
+        raw = max(0, min(thunderborg.COMMAND_ANALOG_MAX, int(round(raw * thunderborg.COMMAND_ANALOG_MAX))))
+        return [raw >> 8, raw & 0xFF]
+
+    def _set_battery_limits(self, data):
+        """ COMMAND_SET_BATT_LIMITS """
+        self.battery_limits = list(data[:2])
+
+    def _write_external_led(self, data):
+        """ COMMAND_WRITE_EXTERNAL_LED, an all zero word starts a new frame """
+        word = list(data[:4])
+        if word == [0, 0, 0, 0]:
+            self.external_leds = []
+        else:
+            self.external_leds.append(word)
+
+    def _set_address(self, data):
+        """ COMMAND_SET_I2C_ADD """
+        self.address = data[0]
+
+class SimulatedBusClass():
+    """ An I2C bus with simulated devices on it, which can be told to misbehave """
+    def __init__(self, devices = None, latency = 0.0, seed = None):
+        """ Sets up the bus
+
+        latency is how long each transaction takes, in seconds
+        """
+        self.devices      = list(devices) if devices is not None else [ThunderBorgSimulatorClass()]
+        self.latency      = latency
+        self.nack_rate    = 0.0
+        self.corrupt_rate = 0.0
+        self.nacks        = 0
+        self.corrupts     = 0
+        self.transactions = 0
+        self.random       = random.Random(seed)
+        self.lock         = threading.RLock()
+
+    def nack_next(self, count = 1):
+        """ Makes the next count transactions fail as if the device did not acknowledge """
+        self.nacks += count
+
+    def corrupt_next(self, count = 1):
+        """ Makes the next count reads return a corrupt reply """
+        self.corrupts += count
+
+    def device_at(self, address):
+        """ Returns the device at an address, or None if there is not one """
+        for device in self.devices:
+            if device.address == address:
+                return device
+        return None
+
+    def _start(self, address):
+        """ Starts a transaction, returning the device or raising the error the kernel would """
+        self.transactions += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        device = self.device_at(address)
+        nack   = self.nacks > 0 or (self.nack_rate > 0 and self.random.random() < self.nack_rate)
+        if device is None or nack:
+            if self.nacks > 0:
+                self.nacks -= 1
+            raise IOError(errno.EREMOTEIO, 'No acknowledgement from %02X' % (address))
+        return device
+
+    def write(self, address, data):
+        """ Writes data to the device at address """
+        with self.lock:
+            self._start(address).write(data)
+
+    def read(self, address, length):
+        """ Reads length bytes from the device at address """
+        with self.lock:
+            reply   = self._start(address).read(length)
+            corrupt = self.corrupts > 0 or (self.corrupt_rate > 0 and self.random.random() < self.corrupt_rate)
+            if corrupt and reply:
+                if self.corrupts > 0:
+                    self.corrupts -= 1
+                reply = bytes([reply[0] ^ 0xFF]) + bytes(self.random.randrange(256) for _ in reply[1:])
+            return reply
+
+    def write_read(self, address, data, length):
+        """ Writes data then reads length bytes back, without letting anything else on the bus in between """
+        with self.lock:
+            self.write(address, data)
+            return self.read(address, length)
+
+class SimulatedTransportClass():
+    """ A ThunderBorg3 transport which talks to a simulated bus """
+    def __init__(self, bus, address):
+        """ Connects to a device on the simulated bus """
+        self.bus     = bus
+        self.address = address
+
+    def write(self, data):
+        """ Writes the bytes in data to the device in a single transaction """
+        self.bus.write(self.address, data)
+
+    def read(self, length):
+        """ Reads length bytes back from the device in a single transaction """
+        return self.bus.read(self.address, length)
+
+    def readinto(self, buffer):
+        """ Reads len(buffer) bytes back from the device into buffer, in a single transaction """
+        reply = self.bus.read(self.address, len(buffer))
+        buffer[:len(reply)] = reply
+        return len(reply)
+
+    def write_read(self, data, length):
+        """ Writes data then reads length bytes back, as one combined transaction """
+        return self.bus.write_read(self.address, data, length)
+
+    def set_address(self, address):
+        """ Switches to talking to a different address on the same bus """
+        self.address = address
+
+    def quick_read(self):
+        """ Reads a single byte, raising an IOError if nothing acknowledges """
+        self.bus.read(self.address, 1)
+
+    def close(self):
+        """ Nothing to close on a simulated bus """
+        pass
+
+def install(buses = None):
+    """ Makes every ThunderBorg initialised from now on use simulated buses, returning them
+
+    buses maps bus numbers to SimulatedBusClass instances, by default there is one
+    ThunderBorg on bus 1 at the default address, and nothing on bus 0
+    """
+    if buses is None:
+        buses = {0: SimulatedBusClass([]), 1: SimulatedBusClass()}
+    def open_transport(bus_number, address):
+        """ Opens a transport on one of the simulated buses """
+        if bus_number not in buses:
+            raise IOError(errno.ENOENT, 'No such simulated bus %d' % (bus_number))
+        return SimulatedTransportClass(buses[bus_number], address)
+    thunderborg.SetTransport(open_transport)
+    return buses
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# coding: Latin-1
+""" Measures the Python side cost of the ThunderBorg command API, against a stand-in bus """
+import argparse
+import contextlib
+import gc
+import io
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+import Classes.ThunderBorg3            as thunderborg
+import Classes.thunderborg_simulator   as simulator
+from   Classes.control_scheduler      import ControlSchedulerClass
+from   Classes.drive_group            import DriveGroupClass
+from   Classes.input_handler          import InputHandlerClass
+from   Classes.joystick_device        import JS_EVENT, JS_EVENT_AXIS, JS_EVENT_BUTTON, JS_EVENT_INIT
+from   Classes.joystick_device        import JoystickDeviceClass, JoystickDeviceInputClass
+from   Classes.led_state              import LED_INTERVAL
+from   Classes.loop_stats             import LoopStatsClass
+from   Classes.mikey_monster          import KEEPALIVE_CHECK
+
+class EchoTransportClass():
+    """ A stand-in bus which answers every GET straight away, so only the ThunderBorg3 side is measured """
+    def __init__(self, bus_number, address):
+        """ Initialises the variables """
+        self.command  = 0
+        self.corrupts = 0
+
+    def corrupt_next(self, count = 1):
+        """ Makes the next count reads come back for the wrong command """
+        self.corrupts += count
+
+    def write(self, data):
+        """ Remembers the command, to echo it back """
+        self.command = data[0]
+
+    def read(self, length):
+        """ Replies with the last command, and a valid ThunderBorg ID """
+        reply = bytearray(length)
+        return bytes(reply[:self.readinto(reply)])
+
+    def readinto(self, buffer):
+        """ Replies with the last command, and a valid ThunderBorg ID, straight into buffer """
+        buffer[0] = self.command
+        if self.corrupts > 0:
+            self.corrupts -= 1
+            buffer[0] ^= 0xFF
+        buffer[1] = thunderborg.I2C_ID_THUNDERBORG
+        buffer[2] = 128
+        return len(buffer)
+
+    def set_address(self, address):
+        """ Nothing to switch, but having it means the board gets a shared bus handle like a real I2C bus does """
+        pass
+
+    def close(self):
+        """ Nothing to close """
+        pass
+
+def make_board(simulated):
+    """ Returns a ThunderBorg on a fresh stand-in bus, and the bus """
+    if simulated:
+        buses = simulator.install({1: simulator.SimulatedBusClass(seed = 0)})
+        bus   = buses[1]
+    else:
+        thunderborg.SetTransport(EchoTransportClass)
+    board = thunderborg.ThunderBorg()
+    board.printFunction = board.NoPrint
+    board.Init()
+    if not simulated:
+        # The board has a handle on the shared bus, the stand-in is underneath it
+        bus = board.transport.bus.transport
+    return board, bus
+
+def benchmarks(board, bus, leds):
+    """ Returns the benchmarks to run, as (name, setup, call) tuples """
+    colours = [[1.0, 0.5, 0.0]] * leds
+    def corrupt_first():
+        """ Makes the next read fail its check, so RawRead has to retry """
+        bus.corrupt_next(1)
+    return [
+        ("RawWrite",                 None,          lambda: board.RawWrite(thunderborg.COMMAND_SET_A_FWD, [128])),
+        ("RawRead",                  None,          lambda: board.RawRead(thunderborg.COMMAND_GET_ID, thunderborg.I2C_MAX_LEN)),
+        ("RawRead with a retry",     corrupt_first, lambda: board.RawRead(thunderborg.COMMAND_GET_ID, thunderborg.I2C_MAX_LEN)),
+        ("SetMotor1",                None,          lambda: board.SetMotor1(0.5)),
+        ("SetMotor2",                None,          lambda: board.SetMotor2(-0.5)),
+        ("SetMotors",                None,          lambda: board.SetMotors(0.75)),
+        ("GetMotor1",                None,          board.GetMotor1),
+        ("GetMotor2",                None,          board.GetMotor2),
+        ("MotorsOff",                None,          board.MotorsOff),
+        ("SetLed1",                  None,          lambda: board.SetLed1(1.0, 0.5, 0.0)),
+        ("SetLed2",                  None,          lambda: board.SetLed2(1.0, 0.5, 0.0)),
+        ("SetLeds",                  None,          lambda: board.SetLeds(1.0, 0.5, 0.0)),
+        ("GetLed1",                  None,          board.GetLed1),
+        ("GetLed2",                  None,          board.GetLed2),
+        ("SetLedShowBattery",        None,          lambda: board.SetLedShowBattery(False)),
+        ("GetLedShowBattery",        None,          board.GetLedShowBattery),
+        ("SetCommsFailsafe",         None,          lambda: board.SetCommsFailsafe(False)),
+        ("GetCommsFailsafe",         None,          board.GetCommsFailsafe),
+        ("GetDriveFault1",           None,          board.GetDriveFault1),
+        ("GetDriveFault2",           None,          board.GetDriveFault2),
+        ("GetBatteryReading",        None,          board.GetBatteryReading),
+        ("GetBatteryMonitoringLimits", None,        board.GetBatteryMonitoringLimits),
+        ("WriteExternalLedWord",     None,          lambda: board.WriteExternalLedWord(255, 1, 2, 3)),
+        ("SetExternalLedColours x%d" % (leds), None, lambda: board.SetExternalLedColours(colours))
+    ]
+
+# Benchmarks which have to run without allocating any memory, checked by --check-allocations
+ALLOCATION_FREE = ("SetMotor1", "SetMotor2", "SetMotors", "MotorsOff")
+
+def percentile(ordered, fraction):
+    """ Returns a percentile of an already sorted list """
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_benchmark(setup, call, iterations):
+    """ Times a call, returning the calls/sec, p50 and p99 in microseconds, and bytes allocated per call """
+    for _ in range(min(100, iterations)):
+        if setup:
+            setup()
+        call()
+    timings = []
+    clock   = time.perf_counter_ns
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            if setup:
+                setup()
+            start = clock()
+            call()
+            timings.append(clock() - start)
+    finally:
+        gc.enable()
+    # Peak memory during a call catches short lived allocations as well as leaks
+    samples   = min(1000, iterations)
+    allocated = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            if setup:
+                setup()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            call()
+            allocated += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    return {
+        "calls_per_sec": 1e9 * len(timings) / sum(timings),
+        "p50_us":        percentile(timings, 0.50) / 1000.0,
+        "p99_us":        percentile(timings, 0.99) / 1000.0,
+        "alloc_bytes":   allocated / float(samples)
+    }
+
+def drive_group_scaling(max_boards, iterations):
+    """ Times a tick's motor writes through DriveGroupClass, for one to max_boards simulated boards
+
+    Straight ahead each board gets one SetMotors, turning each board gets a write per motor
+    """
+    forward = (thunderborg.COMMAND_VALUE_FWD, 200)
+    turning = (thunderborg.COMMAND_VALUE_FWD, 100)
+    print("%-8s %14s %14s %14s %14s" % ("Boards", "straight p50", "straight p99", "turning p50", "turning p99"))
+    for count in range(1, max_boards + 1):
+        addresses = [0x15 + index for index in range(count)]
+        simulator.install({1: simulator.SimulatedBusClass(
+            [simulator.ThunderBorgSimulatorClass(address) for address in addresses], seed = 0
+        )})
+        outputs = []
+        for address in addresses:
+            board               = thunderborg.ThunderBorg()
+            board.printFunction = board.NoPrint
+            board.i2cAddress    = address
+            board.Init()
+            outputs            += [("right", board, 1, False), ("left", board, 2, False)]
+        # Resend every time, so each tick does the full set of writes
+        group     = DriveGroupClass(outputs, resend_interval = 0.0)
+        straight  = run_benchmark(None, lambda: group.set_sides(forward, forward), iterations)
+        turn      = run_benchmark(None, lambda: group.set_sides(forward, turning), iterations)
+        print("%-8d %11.2f us %11.2f us %11.2f us %11.2f us" % (
+            count, straight["p50_us"], straight["p99_us"], turn["p50_us"], turn["p99_us"]
+        ))
+        for writer in group.writers:
+            writer.board.Close()
+
+class SweepingJoystickClass():
+    """ A stand-in joystick whose sticks sweep round in a circle, so every event is a real change """
+    def __init__(self, joystick_id, settings):
+        """ Initialises the variables """
+        self.joystick_id = joystick_id
+        self.settings    = settings
+        self.axes        = {}
+
+    def init(self):
+        """ Nothing to do """
+        pass
+
+    def get_id(self):
+        """ Returns the joystick id """
+        return self.joystick_id
+
+    def get_axis(self, axis):
+        """ Returns an axis position, from -1 to +1 """
+        return self.axes.get(axis, 0.0)
+
+    @staticmethod
+    def get_button(button): # pylint: disable=W0613
+        """ The buttons are never pressed """
+        return 0
+
+    def move(self, angle):
+        """ Moves the sticks to an angle round the circle, a little out of step with the other joysticks """
+        angle += self.joystick_id
+        self.axes[self.settings.left_axis]  = 0.8 * math.sin(angle)
+        self.axes[self.settings.right_axis] = 0.8 * math.cos(angle)
+
+def fleet_scaling(max_robots, seconds, event_rate):
+    """ Runs one shared control loop for one to max_robots simulated robots, measuring the process CPU
+
+    Each robot has its own board on bus 1, its own telemetry thread and a joystick sending
+    event_rate events a second, which is about what a gamepad sends while the sticks move
+    """
+    print("%-8s %10s %14s %10s %12s" % ("Robots", "CPU", "per robot", "moves", "avg latency"))
+    last = 0.0
+    for count in range(1, max_robots + 1):
+        addresses = [0x15 + index for index in range(count)]
+        simulator.install({1: simulator.SimulatedBusClass(
+            [simulator.ThunderBorgSimulatorClass(address) for address in addresses], seed = 0
+        )})
+        with contextlib.redirect_stdout(io.StringIO()):
+            handlers = [InputHandlerClass((1, address)) for address in addresses]
+        joysticks = [SweepingJoystickClass(index, handler.joystick_settings) for index, handler in enumerate(handlers)]
+        finish    = [0.0]
+        due       = [0.0]
+        def poll(timeout):
+            """ Waits for the next round of events, then moves every joystick """
+            now = time.monotonic()
+            if now + timeout < due[0]:
+                time.sleep(timeout)
+                return set(), now < finish[0]
+            time.sleep(max(0.0, due[0] - now))
+            due[0] += 1.0 / event_rate
+            for joystick in joysticks:
+                joystick.move(due[0])
+            return set(range(count)), time.monotonic() < finish[0]
+        stats     = LoopStatsClass()
+        scheduler = ControlSchedulerClass(poll, handlers[0].joystick_settings.interval, stats)
+        for handler, joystick in zip(handlers, joysticks):
+            handler.mikey_monster.enable_failsafe()
+            handler.mikey_monster.telemetry.start()
+            handler.mikey_monster.leds.deferred = True
+            scheduler.add_robot(joystick.get_id(), handler, joystick)
+            scheduler.add_idle_task(handler.mikey_monster.keepalive, KEEPALIVE_CHECK, handler)
+            scheduler.add_idle_task(handler.mikey_monster.leds.flush, LED_INTERVAL, handler)
+        stats.wall_start, stats.cpu_start = time.monotonic(), time.process_time()
+        finish[0] = stats.wall_start + seconds
+        due[0]    = stats.wall_start
+        scheduler.run()
+        cpu = stats.cpu_use()
+        for handler in handlers:
+            handler.mikey_monster.disable_failsafe()
+            handler.mikey_monster.close()
+        print("%-8d %8.2f %% %+11.2f %% %10d %9.2f ms" % (
+            count, cpu, cpu - last, scheduler.moves, stats.average_latency() * 1000.0
+        ))
+        last = cpu
+
+# Starts a joystick backend in a fresh interpreter, so the import and start up are both timed cold
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+from Classes.%s import %s
+backend = %s()
+backend.start()
+print(time.perf_counter() - started)
+"""
+STARTUP_BACKENDS = (
+    ("joystick devices", "joystick_device", "JoystickDeviceInputClass"),
+    ("pygame",           "pygame_input",    "PygameInputClass"),
+)
+
+def backend_startup(module, name):
+    """ Returns how long a joystick backend takes to import and start, or None if it cannot be started here """
+    script = STARTUP_SCRIPT % (module, name, name)
+    result = subprocess.run([sys.executable, "-c", script], capture_output = True, text = True,
+                            cwd = os.path.dirname(os.path.abspath(__file__)), check = False)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.split()[-1])
+
+def check_joystick_device(iterations):
+    """ Feeds js_event records through a pipe into the joystick device backend, returning what went wrong
+
+    Also times each event from being written to poll returning it, and how long each backend takes
+    to start. The pygame backend reads real devices, so only its start up can be compared here
+    """
+    read_fd, write_fd = os.pipe()
+    joysticks         = JoystickDeviceInputClass(["pipe"])
+    joystick          = JoystickDeviceClass("pipe", 0, fd = read_fd)
+    joysticks.add(joystick)
+    failures          = []
+    def send(*events):
+        """ Writes (value, type, number) events to the pipe """
+        records = [JS_EVENT.pack(0, value, event_type, number) for value, event_type, number in events]
+        os.write(write_fd, b"".join(records))
+    def expect(label, moved, axis, button):
+        """ Polls, then checks which joysticks moved and where axis 1 and button 0 ended up """
+        result = joysticks.poll(0.1)[0], joystick.get_axis(1), joystick.get_button(0)
+        if result != (moved, axis, button):
+            failures.append("%s: got %r, expected %r" % (label, result, (moved, axis, button)))
+    send((0, JS_EVENT_AXIS | JS_EVENT_INIT, 1), (0, JS_EVENT_BUTTON | JS_EVENT_INIT, 0))
+    expect("initial state", {0}, 0.0, 0)
+    send((-32767, JS_EVENT_AXIS, 1))
+    expect("axis", {0}, -1.0, 0)
+    send((1, JS_EVENT_BUTTON, 0))
+    expect("button press", {0}, -1.0, 1)
+    send((0, JS_EVENT_BUTTON, 0))
+    expect("button release", set(), -1.0, 0)
+    record = JS_EVENT.pack(0, 32767, JS_EVENT_AXIS, 1)
+    os.write(write_fd, record[:3])
+    expect("half an event", set(), -1.0, 0)
+    os.write(write_fd, record[3:])
+    expect("rest of the event", {0}, 1.0, 0)
+    timings = []
+    for index in range(iterations):
+        started = time.perf_counter_ns()
+        send((index % 32767, JS_EVENT_AXIS, 1))
+        joysticks.poll(0.1)
+        timings.append(time.perf_counter_ns() - started)
+    timings.sort()
+    os.close(write_fd)
+    expect("unplugged", {0}, 0.0, 0)
+    if joystick.connected:
+        failures.append("unplugged: still connected")
+    print("Joystick device")
+    print("  %-21s %.2f us" % ("Event to poll p50:", percentile(timings, 0.50) / 1000.0))
+    print("  %-21s %.2f us" % ("Event to poll p99:", percentile(timings, 0.99) / 1000.0))
+    for label, module, name in STARTUP_BACKENDS:
+        startup = backend_startup(module, name)
+        if startup is None:
+            print("  %-21s not available here" % (label.capitalize() + ":"))
+        else:
+            print("  %-21s %.1f ms" % (label.capitalize() + ":", startup * 1000.0))
+    print("")
+    return failures
+
+def output_results(results, baseline):
+    """ Outputs the results, with the change from the baseline if there is one """
+    print("%-30s %12s %10s %10s %12s" % ("Benchmark", "calls/sec", "p50 us", "p99 us", "alloc B/call"))
+    for name, result in results.items():
+        line = "%-30s %12.0f %10.2f %10.2f %12.1f" % (
+            name, result["calls_per_sec"], result["p50_us"], result["p99_us"], result["alloc_bytes"]
+        )
+        if name in baseline:
+            change = 100.0 * (result["p50_us"] - baseline[name]["p50_us"]) / baseline[name]["p50_us"]
+            line  += "   p50 %+6.1f %%" % (change)
+        print(line)
+
+def regressions(results, baseline, threshold):
+    """ Returns the benchmarks whose p50 got slower than the baseline by more than threshold percent """
+    slower = []
+    for name, result in results.items():
+        if name in baseline:
+            change = 100.0 * (result["p50_us"] - baseline[name]["p50_us"]) / baseline[name]["p50_us"]
+            if change > threshold:
+                slower.append(name)
+    return slower
+
+def parse_arguments():
+    """ Reads the command line arguments """
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument("-n", "--iterations", type = int, default = 20000, help = "calls per benchmark")
+    parser.add_argument("-k", "--filter", default = "", help = "only run benchmarks matching this regular expression")
+    parser.add_argument("--leds", type = int, default = 8, help = "number of LEDs for SetExternalLedColours")
+    parser.add_argument("--save", help = "save the results to this JSON file, to use as a baseline")
+    parser.add_argument("--compare", help = "compare the results against this saved baseline")
+    parser.add_argument("--check-allocations", action = "store_true",
+                        help = "fail if the motor writes allocate any memory, implies --filter for them")
+    parser.add_argument("--check-jsdev", action = "store_true",
+                        help = "instead, feed joystick events through a pipe into the joystick device backend")
+    parser.add_argument("--simulator", action = "store_true",
+                        help = "use the full simulated ThunderBorg instead of the bare stand-in bus")
+    parser.add_argument("--threshold", type = float, default = 25.0,
+                        help = "percent p50 slowdown against the baseline which counts as a failure")
+    parser.add_argument("--boards", type = int, default = 0,
+                        help = "instead, time a drive group tick for one up to this many simulated boards")
+    parser.add_argument("--robots", type = int, default = 0,
+                        help = "instead, measure the CPU of one control loop driving one up to this many robots")
+    parser.add_argument("--seconds", type = float, default = 5.0, help = "how long to drive for with --robots")
+    parser.add_argument("--event-rate", type = float, default = 100.0,
+                        help = "joystick events per second per robot with --robots")
+    return parser.parse_args()
+
+def main():
+    """ Runs the benchmarks """
+    arguments = parse_arguments()
+    if arguments.check_jsdev:
+        failures = check_joystick_device(min(arguments.iterations, 1000))
+        if failures:
+            print("Joystick device failures: " + "; ".join(failures))
+            sys.exit(1)
+        return
+    if arguments.boards:
+        drive_group_scaling(arguments.boards, arguments.iterations)
+        return
+    if arguments.robots:
+        fleet_scaling(arguments.robots, arguments.seconds, arguments.event_rate)
+        return
+    board, bus = make_board(arguments.simulator)
+    results = {}
+    for name, setup, call in benchmarks(board, bus, arguments.leds):
+        if arguments.check_allocations and name not in ALLOCATION_FREE:
+            continue
+        if re.search(arguments.filter, name):
+            results[name] = run_benchmark(setup, call, arguments.iterations)
+    baseline = {}
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    output_results(results, baseline)
+    if arguments.save:
+        with open(arguments.save, "w") as results_file:
+            json.dump(results, results_file, indent = 4, sort_keys = True)
+    if arguments.check_allocations:
+        allocating = [name for name, result in results.items() if result["alloc_bytes"] > 0]
+        if allocating:
+            print("Allocating memory: " + ", ".join(allocating))
+            sys.exit(1)
+    slower = regressions(results, baseline, arguments.threshold)
+    if slower:
+        print("Slower than the baseline: " + ", ".join(slower))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,306 @@
 #!/usr/bin/env python3
 # coding: Latin-1
 """ Makes the MonsterBorg remote controllable """
-import time
+import argparse
+import asyncio
 import os
+import time
 import sys
-import pygame
-from   Classes.input_handler import InputHandlerClass
+import Classes.ThunderBorg3          as thunderborg
+import Classes.thunderborg_simulator as simulator
+from   Classes.async_runtime         import AsyncRuntimeClass
+from   Classes.control_scheduler     import ControlSchedulerClass
+from   Classes.flight_recorder       import FlightRecorderClass
+from   Classes.input_handler         import InputHandlerClass
+from   Classes.led_state             import LED_INTERVAL
+from   Classes.loop_stats            import LoopStatsClass
+from   Classes.mikey_monster         import KEEPALIVE_CHECK
+from   Classes.mikey_functions       import absolute_path
+from   Classes.startup_phases        import StartupPhasesClass
+
+# How long to wait for a joystick to be plugged in before checking on the board again, in seconds
+JOYSTICK_WAIT = 0.5
 
-def user_abort(mikey_monster = False):
+def user_abort(mikey_monsters = ()):
     """ Safely exits the program when the user aborts """
     print("User aborted :'(")
-    if mikey_monster:
+    for mikey_monster in mikey_monsters:
         mikey_monster.disable_failsafe()
         mikey_monster.set_leds(0, 0, 0)
+        mikey_monster.leds.flush(True)
     sys.exit()
 
-def show_exception(exception, mikey_monster = False):
+def show_exception(exception, mikey_monsters = (), joysticks = False):
     """ Outputs an exception """
     print(str(exception))
-    if mikey_monster:
+    for mikey_monster in mikey_monsters:
         mikey_monster.set_leds(0, 0, 1)
-        pygame.joystick.quit()
-
-def connect_to_joystick(mikey_monster):
-    """ Attempts to connect to the joystick """
-    pygame.joystick.init()
-    # Attempt to setup the joystick
-    if pygame.joystick.get_count() < 1:
-        # No joystick, set LEDs to blue
-        mikey_monster.set_leds(0, 0, 1)
-        pygame.joystick.quit()
-        time.sleep(0.1)
+    if joysticks:
+        joysticks.reset()
+
+def robot_location(text):
+    """ Turns BUS:ADDRESS from the command line into a (bus number, address) """
+    try:
+        bus_number, address = text.split(":")
+        return int(bus_number, 0), int(address, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected BUS:ADDRESS, such as 1:0x15, not %r" % (text))
+
+def robot_name(name, index, count):
+    """ Numbers a name after the robot it is for, when there is more than one """
+    return name if count == 1 else "%s %d" % (name, index + 1)
+
+def open_joysticks(arguments):
+    """ Returns the joystick backend, only loading pygame if it is going to be used """
+    if arguments.input == "jsdev":
+        from Classes.joystick_device import JoystickDeviceInputClass
+        return JoystickDeviceInputClass(arguments.device)
+    from Classes.pygame_input import PygameInputClass
+    return PygameInputClass()
+
+def start_board(phases, location = None, index = 0, count = 1):
+    """ Sets up a ThunderBorg and reads the battery details, which can run while waiting for a joystick """
+    with phases.phase(robot_name("ThunderBorg", index, count)):
+        input_handler = InputHandlerClass(location)
+    with phases.phase(robot_name("Battery details", index, count)):
+        battery = input_handler.get_battery_details()
+    return input_handler, battery
+
+def boards_ready(boards):
+    """ Returns the MikeyMonsters which have been set up so far, raising anything that went wrong setting one up """
+    ready = [board.result(0) for board in boards]
+    return [robot[0].mikey_monster for robot in ready if robot is not None]
+
+def connect_to_joysticks(mikey_monsters, joysticks, count):
+    """ Attempts to connect to a joystick for each robot """
+    connected = joysticks.connect_all(count)
+    # Attempt to setup the joysticks
+    if not connected:
+        # Not enough joysticks, set LEDs to blue on whichever boards are there to show them
+        for mikey_monster in mikey_monsters:
+            mikey_monster.set_leds(0, 0, 1)
+        joysticks.wait(JOYSTICK_WAIT)
         return False
-    # There is a joystick, attempt to initialise
-    return pygame.joystick.Joystick(0)
+    # There are joysticks
+    return connected
 
-def connect_joystick(mikey_monster):
-    """ Connects to a joystick """
+def connect_joysticks(boards, joysticks):
+    """ Connects to a joystick for each board, while the boards are set up in the background """
     while True:
+        mikey_monsters = boards_ready(boards)
         try:
-            joystick = connect_to_joystick(mikey_monster)
-            if joystick:
-                return joystick
+            connected = connect_to_joysticks(mikey_monsters, joysticks, len(boards))
+            if connected:
+                return connected
         except KeyboardInterrupt:
             # Cancelled searching
-            user_abort(mikey_monster)
+            user_abort(mikey_monsters)
         except Exception as ex: # pylint: disable=W0703
-            show_exception(ex, mikey_monster)
+            show_exception(ex, mikey_monsters, joysticks)
             time.sleep(0.1)
     return False
 
-def had_event(event):
-    """ Check that there has been a valid event """
-    running    = True
-    temp_event = False
-    # print(event)
-    if event.type == pygame.QUIT:
-        running = False
-    elif event.type == pygame.JOYBUTTONDOWN:
-        temp_event = True
-    elif event.type == pygame.JOYAXISMOTION:
-        temp_event = True
-    return temp_event, running
+def watch_joysticks(joysticks, robots, reconnected):
+    """ Stops a MikeyMonster when its joystick is unplugged, and hands over the joystick when it is back
+
+    robots maps each joystick id to the InputHandlerClass it drives
+    """
+    def lost(joystick):
+        """ Stops the motors, and shows the joystick has gone """
+        input_handler = robots.get(joystick.get_id())
+        if input_handler is None:
+            return
+        mikey_monster = input_handler.mikey_monster
+        mikey_monster.stop_motors()
+        # The motors have been stopped behind the filter's back, so make sure the sticks count again
+        input_handler.input_filter.reset()
+        mikey_monster.led_show_battery(False)
+        mikey_monster.set_leds(0, 0, 1)
+        print("Joystick %d lost, waiting for it to come back" % (joystick.get_id()))
+    def connected(joystick):
+        """ Starts using the joystick again """
+        input_handler = robots.get(joystick.get_id())
+        if input_handler is None:
+            return
+        reconnected(joystick, input_handler)
+        input_handler.mikey_monster.led_show_battery(True)
+    joysticks.on_removed   = lost
+    joysticks.on_connected = connected
+
+def recorder_path(path, index, count):
+    """ Returns the flight recorder file for a robot, each robot after the first gets its own """
+    if count == 1 or index == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return "%s-%d%s" % (root, index + 1, extension)
+
+def parse_arguments():
+    """ Reads the command line arguments """
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument("--async", dest = "async_mode", action = "store_true",
+                        help = "run input, control and telemetry as asyncio tasks, with a dedicated I2C thread")
+    parser.add_argument("--record", nargs = "?", const = absolute_path("flight_recorder.bin"), metavar = "FILE",
+                        help = "keep the last few minutes of control data in a flight recorder file")
+    parser.add_argument("--record-minutes", type = float, default = 10.0,
+                        help = "how many minutes the flight recorder keeps")
+    parser.add_argument("--input", choices = ["pygame", "jsdev"], default = "pygame",
+                        help = "read the joystick through pygame, or straight from the joystick device")
+    parser.add_argument("--device", action = "append",
+                        help = "the joystick device to read with --input jsdev, once for each --robot")
+    parser.add_argument("--robot", action = "append", type = robot_location, metavar = "BUS:ADDRESS",
+                        help = "drive the ThunderBorg at this bus and address, repeat to drive several robots at once")
+    arguments = parser.parse_args()
+    count     = len(arguments.robot or [None])
+    if arguments.device is None:
+        arguments.device = ["/dev/input/js%d" % (index) for index in range(count)]
+    if arguments.input == "jsdev" and len(arguments.device) != count:
+        parser.error("--input jsdev needs one --device for each --robot")
+    if arguments.async_mode and count > 1:
+        parser.error("--async can only drive one robot")
+    return arguments
 
 def main():
     """ Run when the program starts """
+    phases    = StartupPhasesClass()
+    arguments = parse_arguments()
+    if os.environ.get("THUNDERBORG_SIMULATE"):
+        # Drive a simulated ThunderBorg instead of the real bus
+        simulator.install()
+    locations = arguments.robot or [None]
+    count     = len(locations)
     # Redirect the output to standard error, to ignore some pygame errors
     sys.stdout = sys.stderr
-    input_handler = InputHandlerClass()
-    # Output the battery details
-    output_battery(input_handler.get_battery_details())
-    # Remove the need for a GUI window
-    os.environ["SDL_VIDEODRIVER"] = "dummy"
-    # Init pygame and wait for a joystick
-    pygame.init()
-    # Connect to a joystick, if there is one, and then initiate it
-    print("Waiting for joystick, press CTRL+C to abort")
-    joystick = connect_joystick(input_handler.mikey_monster)
-    joystick.init()
-    print("Found a joystick")
-    # Use the LEDs like normal
-    input_handler.mikey_monster.led_show_battery(True)
+    # The boards and the joysticks do not depend on each other, so set the boards up in the background
+    boards = [
+        phases.background(start_board, phases, location, index, count)
+        for index, location in enumerate(locations)
+    ]
+    # The joystick backend stays on the main thread, as pygame expects
+    with phases.phase("Joystick backend"):
+        joysticks = open_joysticks(arguments)
+        joysticks.start()
+    # Connect to a joystick for each robot, once there are enough, and then initiate them
+    print("Waiting for %s, press CTRL+C to abort" % ("joystick" if count == 1 else "%d joysticks" % (count)))
+    with phases.phase("Joystick"):
+        connected = connect_joysticks(boards, joysticks)
+        for joystick in connected:
+            joysticks.prepare(joystick)
+    with phases.phase("Waiting for board"):
+        try:
+            ready = [board.result() for board in boards]
+        except KeyboardInterrupt:
+            user_abort(boards_ready(boards))
+    # Joystick n drives robot n
+    robots = [(input_handler, joystick) for (input_handler, _), joystick in zip(ready, connected)]
+    for index, (input_handler, battery) in enumerate(ready):
+        print("%s ready for motor commands after %.3f s" % (
+            robot_name("ThunderBorg", index, count), input_handler.mikey_monster.startup_time
+        ))
+        # Output the battery details
+        output_battery(battery, robot_name("Battery monitoring settings", index, count))
+    if arguments.record:
+        with phases.phase("Flight recorder"):
+            for index, (input_handler, _) in enumerate(robots):
+                interval = input_handler.joystick_settings.interval
+                input_handler.recorder = FlightRecorderClass(
+                    recorder_path(arguments.record, index, count),
+                    arguments.record_minutes,
+                    1.0 / interval if interval > 0 else 50.0
+                )
+    phases.report()
+    stats     = LoopStatsClass()
+    scheduler = ControlSchedulerClass(
+        joysticks.poll,
+        robots[0][0].joystick_settings.interval,
+        stats,
+        joysticks.idle_timeout
+    )
+    for index, (input_handler, joystick) in enumerate(robots):
+        mikey_monster = input_handler.mikey_monster
+        # Keep the failsafe on for the whole run, so the motors stop if this program does
+        if not mikey_monster.enable_failsafe():
+            print("Could not turn the comms failsafe on for %s" % (robot_name("the robot", index, count)))
+        # Use the LEDs like normal, and start keeping an eye on the battery and drive faults
+        mikey_monster.led_show_battery(True)
+        if not arguments.async_mode:
+            # In async mode the runtime does the readings on its I2C worker instead
+            mikey_monster.telemetry.start()
+        # Every robot shares the one loop, each joystick's events go to its own robot
+        scheduler.add_robot(joystick.get_id(), input_handler, joystick)
+        # Only writes anything when the sticks are held still with the motors running
+        scheduler.add_idle_task(mikey_monster.keepalive, KEEPALIVE_CHECK, input_handler)
+        # From now on the LEDs only get written in the time left over after the motor commands
+        mikey_monster.leds.deferred = True
+        scheduler.add_idle_task(mikey_monster.leds.flush, LED_INTERVAL, input_handler)
+    runtime   = None
+    if arguments.async_mode:
+        runtime = AsyncRuntimeClass(
+            robots[0][0], robots[0][1], joysticks.poll, stats, joysticks.idle_timeout, joysticks.poll_anywhere
+        )
+    def reconnected(joystick, input_handler):
+        """ Gives the loops the joystick object to use from now on """
+        scheduler.add_robot(joystick.get_id(), input_handler, joystick)
+        if runtime:
+            runtime.joystick = joystick
+    watch_joysticks(
+        joysticks,
+        dict((joystick.get_id(), input_handler) for input_handler, joystick in robots),
+        reconnected
+    )
     # This deals with the inputs
     try:
         print("Press CTRL+C to quit")
-        running     = True
-        was_event   = False
-        # Loop indefinitely
-        while running:
-            # Get the latest events from the system
-            was_event = False
-            events = pygame.event.get()
-            # Handle each event
-            for event in events:
-                running, was_event = had_event(event)
-                if was_event:
-                    input_handler.execute_move(joystick)
+        if runtime:
+            asyncio.run(runtime.run())
+        else:
+            # Loop indefinitely, sending at most one move per tick to each robot
+            scheduler.run()
     except KeyboardInterrupt:
         # CTRL+C exit, so quit gracefully
-        input_handler.mikey_monster.turn_off()
+        pass
+    finally:
+        # However the loop ended, including a pygame QUIT, stop every robot rather than leaving it to the failsafe
+        for input_handler, _ in robots:
+            input_handler.mikey_monster.turn_off()
+    stats.report()
+    scheduler.report()
+    joysticks.report()
+    for index, (input_handler, _) in enumerate(robots):
+        if count > 1:
+            print("%s:" % (robot_name("Robot", index, count)))
+            print("")
+        input_handler.input_filter.report()
+        input_handler.mikey_monster.motors.report()
+        input_handler.mikey_monster.leds.report()
+        input_handler.mikey_monster.telemetry.report()
+        input_handler.mikey_monster.report_errors()
+        if input_handler.recorder:
+            input_handler.recorder.close()
+    output_buses()
+    for input_handler, _ in robots:
+        input_handler.mikey_monster.close()
+
+def output_buses():
+    """ Outputs how the I2C buses have been shared, and how long each class of command waited for them """
+    for bus in thunderborg.SharedBusStats():
+        print("I2C bus %d:" % (bus["busNumber"]))
+        print("  Handles open         %d" % (bus["users"]))
+        print("  Waited for the bus   %d" % (bus["contended"]))
+        print("  Address switches     %d" % (bus["addressSwitches"]))
+        if bus["combinedReads"] is not None:
+            print("  Combined reads       %d" % (bus["combinedReads"]))
+        print("  Class     Waited  Replaced  Promoted  Queued (max)  Average wait  Longest wait  Over target")
+        for stats in bus["classes"]:
+            average = stats["waitTotal"] / stats["waited"] if stats["waited"] else 0.0
+            print("  %-9s %6d %9d %9d %7d (%3d) %10.3f ms %10.3f ms %6d (%g ms)" % (
+                stats["name"], stats["waited"], stats["replaced"], stats["promoted"], stats["depth"], stats["depthMax"],
+                average * 1000.0, stats["waitMax"] * 1000.0, stats["late"], stats["target"] * 1000.0
+            ))
+        print("")
 
-def output_battery(battery):
+def output_battery(battery, title = "Battery monitoring settings"):
     """ Outputs the status of the battery """
-    print("Battery monitoring settings:")
+    print("%s:" % (title))
     print("  Minimum  (red)       %02.2f V" % (battery["minimum"]))
     print("  Half-way (yellow)    %02.2f V" % ((battery["minimum"] + battery["maximum"]) / 2))
     print("  Maximum  (green)     %02.2f V" % (battery["maximum"]))